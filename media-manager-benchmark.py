@@ -0,0 +1,670 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark both media manager revisions against local stand-in Plex, Radarr, Sonarr, Tautulli and Overseerr servers
+
+The stand-in servers serve a synthetic library on the endpoints the scripts call, and every pipeline stage
+is reported with its wall time, request count, bytes transferred and peak Python memory.
+
+    python media-manager-benchmark.py --items 20000 --output bench.json
+"""
+
+import abc
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import quoteattr
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REVISIONS = {
+    'revision-1': os.path.join(SCRIPT_DIRECTORY, 'media-manager-revision-1.py'),
+    'revision-3': os.path.join(SCRIPT_DIRECTORY, 'media-manager-revision-3.py'),
+}
+
+MOVIE_SHARE = 0.7  # Share of the synthetic items that are movies, the rest are shows
+WATCHED_SHARE = 0.6  # Share of the synthetic items that have been played at least once
+EPISODES_PER_SEASON = 10
+MAX_SEASONS_PER_SHOW = 4
+SEASON_INTERVAL = 180 * 86400  # Seconds between the seasons of a synthetic show
+FREE_SPACE = 200 * 1073741824  # Bytes reported free on /data, below the default 500 GB threshold
+TOTAL_SPACE = 40 * 1099511627776
+POLICY_ITEMS = 200000  # Candidates the retention scoring is timed on, the built ones repeated to reach it
+POLICY_WEIGHTS = {'age': 1.0, 'size': 5.0, 'play_count': -30.0, 'rating': -20.0, 'requested': -200.0}
+MOVIES_SECTION = {'section_id': '1', 'section_name': 'Movies', 'section_type': 'movie'}
+SHOWS_SECTION = {'section_id': '2', 'section_name': 'TV Shows', 'section_type': 'show'}
+STARTUP_BUDGET = 2.0  # Seconds revision 3 may take from process start to deciding that no cleanup is needed
+STARTUP_DEFERRED_MODULES = ('plexapi', 'numpy', 'http.server', 'xml.etree.ElementTree')  # Never loaded by that check
+# Run in a fresh interpreter so only what revision 3 itself imports ends up in sys.modules
+STARTUP_PROBE = '''
+import importlib.util, json, sys
+spec = importlib.util.spec_from_file_location('revision_3', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+diskspace = module.get_diskspace(module.SERVICE_TO_CHECK_FREE_DISKSPACE)
+bytes_to_delete = module.check_diskspace(diskspace, module.SERVICE_TO_CHECK_FREE_DISKSPACE,
+                                         {module.PATH_TO_CHECK: int(sys.argv[2])})
+print(json.dumps({'bytes_to_delete': len(bytes_to_delete), 'loaded': [name for name in sys.argv[3:] if name in sys.modules]}))
+'''
+OVERVIEW = 'A synthetic overview that pads every record to the size of a real Radarr or Sonarr response. ' * 4
+
+
+def generate_library(items, seed):
+    """Return synthetic movies and shows with GUIDs, sizes and watch history"""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    library = {'movie': [], 'show': []}
+
+    for i in range(items):
+        added_at = now - rnd.randint(0, 10 * 365 * 86400)
+        media_type = 'movie' if i < items * MOVIE_SHARE else 'show'
+        title = 'Synthetic {} {}'.format(media_type.capitalize(), i)
+        year = 1950 + i % 75
+
+        item = {
+            'arr_id': len(library[media_type]) + 1,
+            'rating_key': 1000 + i,
+            'title': title,
+            'year': year,
+            'added_at': added_at,
+            'last_viewed_at': rnd.randint(added_at, now) if rnd.random() < WATCHED_SHARE else None,
+            'imdb_id': 'tt{:07d}'.format(i),
+            'tmdb_id': 100000 + i,
+            'tvdb_id': 200000 + i,
+            'size': rnd.randint(700 * 1048576, 60 * 1073741824),
+            'rating': round(rnd.uniform(2, 9.5), 1),
+        }
+        if media_type == 'movie':
+            item['path'] = '/data/movies/{} ({})'.format(title, year)
+            item['file'] = '{} ({}).mkv'.format(title, year)
+        else:
+            item['path'] = '/data/tv/{}'.format(title)
+            item['seasons'] = 1 + i % MAX_SEASONS_PER_SHOW
+        library[media_type].append(item)
+
+    return library
+
+
+def generate_history(library):
+    history = []
+    for movie in library['movie']:
+        if movie['last_viewed_at']:
+            history.append({'type': 'movie', 'rating_key': movie['rating_key'], 'title': movie['title'],
+                            'viewed_at': movie['last_viewed_at']})
+    for show in library['show']:
+        if show['last_viewed_at']:
+            # The latest season was watched last, every earlier one a season interval before it
+            for season in range(1, show['seasons'] + 1):
+                season_viewed_at = max(show['added_at'], show['last_viewed_at'] - (show['seasons'] - season) * SEASON_INTERVAL)
+                for episode in range(EPISODES_PER_SEASON):
+                    history.append({'type': 'episode', 'rating_key': (show['rating_key'] * 10 + season) * 100 + episode,
+                                    'grandparent_rating_key': show['rating_key'], 'parent_index': season,
+                                    'index': episode + 1, 'title': 'Episode {}'.format(episode + 1),
+                                    'grandparent_title': show['title'],
+                                    'viewed_at': season_viewed_at - (EPISODES_PER_SEASON - episode) * 3600})
+    history.sort(key=lambda entry: entry['viewed_at'], reverse=True)
+    return history
+
+
+def radarr_movie(movie):
+    return {
+        'id': movie['arr_id'],
+        'title': movie['title'],
+        'year': movie['year'],
+        'overview': OVERVIEW,
+        'images': [{'coverType': 'poster', 'url': '/MediaCover/{}/poster.jpg'.format(movie['arr_id'])}],
+        'imdbId': movie['imdb_id'],
+        'tmdbId': movie['tmdb_id'],
+        'path': movie['path'],
+        'hasFile': True,
+        'sizeOnDisk': movie['size'],
+        'added': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(movie['added_at'])),
+        'movieFile': {
+            'id': movie['arr_id'],
+            'relativePath': movie['file'],
+            'path': '{}/{}'.format(movie['path'], movie['file']),
+            'size': movie['size'],
+        },
+    }
+
+
+def sonarr_series(show):
+    return {
+        'id': show['arr_id'],
+        'title': show['title'],
+        'year': show['year'],
+        'overview': OVERVIEW,
+        'images': [{'coverType': 'poster', 'url': '/MediaCover/{}/poster.jpg'.format(show['arr_id'])}],
+        'imdbId': show['imdb_id'],
+        'tmdbId': show['tmdb_id'],
+        'tvdbId': show['tvdb_id'],
+        'path': show['path'],
+        'seasons': [{'seasonNumber': season, 'monitored': True,
+                     'statistics': {'sizeOnDisk': show['size'] // show['seasons'],
+                                    'previousAiring': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(
+                                        min(show['added_at'] + (season - 1) * SEASON_INTERVAL, int(time.time()))))}}
+                    for season in range(1, show['seasons'] + 1)],
+        'statistics': {'seasonCount': show['seasons'], 'episodeFileCount': show['seasons'] * EPISODES_PER_SEASON,
+                       'sizeOnDisk': show['size']},
+    }
+
+
+def sonarr_episode_files(show):
+    episode_files = []
+    for season in range(1, show['seasons'] + 1):
+        added_at = min(show['added_at'] + (season - 1) * SEASON_INTERVAL, int(time.time()))
+        for episode in range(1, EPISODES_PER_SEASON + 1):
+            relative_path = 'Season {:02d}/{} - S{:02d}E{:02d}.mkv'.format(season, show['title'], season, episode)
+            episode_files.append({
+                'id': (show['arr_id'] * 10 + season) * 100 + episode,
+                'seriesId': show['arr_id'],
+                'seasonNumber': season,
+                'relativePath': relative_path,
+                'path': '{}/{}'.format(show['path'], relative_path),
+                'size': show['size'] // (show['seasons'] * EPISODES_PER_SEASON),
+                'dateAdded': time.strftime('%Y-%m-%dT%H:%M:%S.0000000Z', time.gmtime(added_at)),
+                'quality': {'quality': {'id': 7, 'name': 'Bluray-1080p', 'source': 'bluray', 'resolution': 1080}},
+            })
+    return episode_files
+
+
+def plex_guids(item, media_type):
+    guids = ['imdb://{}'.format(item['imdb_id']), 'tmdb://{}'.format(item['tmdb_id'])]
+    if media_type == 'show':
+        guids.append('tvdb://{}'.format(item['tvdb_id']))
+    return guids
+
+
+def plex_json_item(item, media_type):
+    result = {
+        'ratingKey': str(item['rating_key']),
+        'key': '/library/metadata/{}'.format(item['rating_key']),
+        'type': media_type,
+        'title': item['title'],
+        'year': item['year'],
+        'summary': OVERVIEW,
+        'addedAt': item['added_at'],
+        'updatedAt': item['added_at'],
+        'audienceRating': item['rating'],
+        'Guid': [{'id': guid} for guid in plex_guids(item, media_type)],
+    }
+    if item['last_viewed_at']:
+        result['lastViewedAt'] = item['last_viewed_at']
+        result['viewCount'] = 1
+    if media_type == 'movie':
+        result['Media'] = [{'Part': [{'file': '{}/{}'.format(item['path'], item['file']), 'size': item['size']}]}]
+    else:
+        result['childCount'] = item['seasons']
+        result['leafCount'] = item['seasons'] * EPISODES_PER_SEASON
+        result['Location'] = [{'path': item['path']}]
+    return result
+
+
+def plex_xml_item(item, media_type):
+    attributes = ' '.join('{}={}'.format(name, quoteattr(str(value))) for name, value in (
+        ('ratingKey', item['rating_key']),
+        ('key', '/library/metadata/{}'.format(item['rating_key'])),
+        ('type', media_type),
+        ('title', item['title']),
+        ('year', item['year']),
+        ('summary', OVERVIEW),
+        ('addedAt', item['added_at']),
+        ('updatedAt', item['added_at']),
+        ('audienceRating', item['rating']),
+        ('lastViewedAt', item['last_viewed_at'] or ''),
+        ('viewCount', 1 if item['last_viewed_at'] else ''),
+    ) if value != '')
+    children = ''.join('<Guid id={}/>'.format(quoteattr(guid)) for guid in plex_guids(item, media_type))
+
+    if media_type == 'movie':
+        children += '<Media id="{0}"><Part id="{0}" file={1} size="{2}"/></Media>'.format(
+            item['rating_key'], quoteattr('{}/{}'.format(item['path'], item['file'])), item['size'])
+        return '<Video {}>{}</Video>'.format(attributes, children)
+    leaf_count = item['seasons'] * EPISODES_PER_SEASON
+    attributes += ' childCount="{}" leafCount="{}" viewedLeafCount="{}"'.format(
+        item['seasons'], leaf_count, leaf_count if item['last_viewed_at'] else 0)
+    children += '<Location path={}/>'.format(quoteattr(item['path']))
+    return '<Directory {}>{}</Directory>'.format(attributes, children)
+
+
+def plex_xml_history_entry(entry):
+    attributes = {
+        'historyKey': '/status/sessions/history/{}'.format(entry['rating_key']),
+        'ratingKey': entry['rating_key'],
+        'key': '/library/metadata/{}'.format(entry['rating_key']),
+        'type': entry['type'],
+        'title': entry['title'],
+        'viewedAt': entry['viewed_at'],
+        'accountID': 1,
+        'deviceID': 1,
+    }
+    if entry['type'] == 'episode':
+        attributes.update({
+            'grandparentRatingKey': entry['grandparent_rating_key'],
+            'grandparentKey': '/library/metadata/{}'.format(entry['grandparent_rating_key']),
+            'grandparentTitle': entry['grandparent_title'],
+            'parentIndex': entry['parent_index'],
+            'index': entry['index'],
+        })
+    return '<Video {}/>'.format(' '.join('{}={}'.format(name, quoteattr(str(value))) for name, value in attributes.items()))
+
+
+def tautulli_media(item, media_type):
+    return {
+        'rating_key': str(item['rating_key']),
+        'title': item['title'],
+        'year': str(item['year']),
+        'media_type': media_type,
+        'added_at': str(item['added_at']),
+        'last_played': item['last_viewed_at'],
+        'play_count': 1 if item['last_viewed_at'] else None,
+        'file_size': str(item['size']),
+    }
+
+
+def overseerr_request(item, media_type, request_id):
+    return {
+        'id': request_id,
+        'status': 2,
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(item['added_at'])),
+        'type': 'movie' if media_type == 'movie' else 'tv',
+        'media': {
+            'id': request_id,
+            'mediaType': 'movie' if media_type == 'movie' else 'tv',
+            'tmdbId': item['tmdb_id'],
+            'tvdbId': item['tvdb_id'] if media_type == 'show' else None,
+        },
+    }
+
+
+class FakeService(abc.ABC):
+    """Routes requests for one stand-in upstream service and counts what it serves"""
+
+    def __init__(self, name, library, history):
+        self.name = name
+        self.library = library
+        self.history = history
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def cached(self, key, build):
+        # Large bodies are rendered once and served from memory so the stand-ins don't dominate the timings
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = build()
+            return self.cache[key]
+
+    def record(self, body):
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(body)
+
+    @abc.abstractmethod
+    def handle(self, method, path, query, headers):
+        """Return the status, content type and body answering one request"""
+
+
+class FakeArr(FakeService):
+    def __init__(self, name, library, history, resource, media_type, build_item):
+        super().__init__(name, library, history)
+        self.resource = resource
+        self.media_type = media_type
+        self.build_item = build_item
+
+    def handle(self, method, path, query, headers):
+        items = self.library[self.media_type]
+        prefix = '/api/v3/{}'.format(self.resource)
+
+        if method == 'DELETE':
+            return 200, 'application/json', b''
+        if method == 'POST':
+            return 202, 'application/json', b'{}'
+        if path == prefix:
+            return 200, 'application/json', self.cached(path, lambda: json.dumps([self.build_item(item) for item in items]).encode())
+        if path.startswith(prefix + '/'):
+            item_id = int(path.rsplit('/', 1)[-1])
+            if item_id > len(items):
+                return 404, 'application/json', b'{}'
+            return 200, 'application/json', json.dumps(self.build_item(items[item_id - 1])).encode()
+        if path == '/api/v3/diskspace':
+            return 200, 'application/json', json.dumps([{'path': '/data', 'label': '', 'freeSpace': FREE_SPACE,
+                                                         'totalSpace': TOTAL_SPACE}]).encode()
+        if path == '/api/v3/episodefile' and self.media_type == 'show':
+            show = items[int(query['seriesId']) - 1]
+            return 200, 'application/json', json.dumps(sonarr_episode_files(show)).encode()
+        if path == '/api/v3/history/since':
+            return 200, 'application/json', b'[]'
+        return 404, 'application/json', b'{}'
+
+
+class FakeTautulli(FakeService):
+    def handle(self, method, path, query, headers):
+        cmd = query.get('cmd')
+        sections = ((MOVIES_SECTION, 'movie'), (SHOWS_SECTION, 'show'))
+
+        if cmd == 'get_libraries_table':
+            data = [dict(section, rating_key='', count=len(self.library[media_type])) for section, media_type in sections]
+            return 200, 'application/json', json.dumps({'response': {'result': 'success', 'data': {'data': data}}}).encode()
+        if cmd == 'get_library_media_info':
+            media_type = 'movie' if query['section_id'] == MOVIES_SECTION['section_id'] else 'show'
+            order_column = query.get('order_column', 'last_played')
+            rows = self.cached((media_type, order_column), lambda: sorted(
+                [tautulli_media(item, media_type) for item in self.library[media_type]],
+                key=lambda row: int(row[order_column] or 0), reverse=True))
+            start = int(query.get('start', 0))
+            length = int(query.get('length', 25))
+            data = {'recordsTotal': len(rows), 'recordsFiltered': len(rows), 'data': rows[start:start + length]}
+            return 200, 'application/json', json.dumps({'response': {'result': 'success', 'data': data}}).encode()
+        return 400, 'application/json', b'{}'
+
+
+class FakeOverseerr(FakeService):
+    def handle(self, method, path, query, headers):
+        if method == 'DELETE' and path.startswith('/api/v1/media/'):
+            return 204, 'application/json', b''
+        if path != '/api/v1/request':
+            return 404, 'application/json', b'{}'
+
+        requests = self.cached('requests', lambda: [
+            overseerr_request(item, media_type, index + 1)
+            for index, (media_type, item) in enumerate(
+                [('movie', movie) for movie in self.library['movie']] + [('show', show) for show in self.library['show']])])
+        skip = int(query.get('skip', 0))
+        take = int(query.get('take', 10))
+        body = {
+            'pageInfo': {'pages': (len(requests) + take - 1) // take, 'pageSize': take, 'results': len(requests),
+                         'page': skip // take + 1},
+            'results': requests[skip:skip + take],
+        }
+        return 200, 'application/json', json.dumps(body).encode()
+
+
+class FakePlex(FakeService):
+    def page(self, items, query, headers):
+        start = int(query.get('X-Plex-Container-Start') or headers.get('X-Plex-Container-Start') or 0)
+        size = query.get('X-Plex-Container-Size') or headers.get('X-Plex-Container-Size')
+        return items[start:start + int(size)] if size is not None else items[start:]
+
+    def handle(self, method, path, query, headers):
+        wants_json = 'application/json' in headers.get('Accept', '')
+        sections = ((MOVIES_SECTION, 'movie'), (SHOWS_SECTION, 'show'))
+        path = path.rstrip('/') or '/'
+
+        if path == '/':
+            return 200, 'application/xml', (b'<MediaContainer size="0" friendlyName="benchmark" machineIdentifier="benchmark" '
+                                           b'version="1.40.0.0" myPlex="0"/>')
+        if path == '/library':
+            return 200, 'application/xml', b'<MediaContainer size="0"/>'
+        if path == '/library/sections':
+            if wants_json:
+                directories = [{'key': section['section_id'], 'type': media_type, 'title': section['section_name']}
+                               for section, media_type in sections]
+                return 200, 'application/json', json.dumps({'MediaContainer': {'size': 2, 'Directory': directories}}).encode()
+            directories = ''.join('<Directory key="{}" type="{}" title={} agent="tv.plex.agents.{}" uuid="{}">'
+                                  '<Location id="{}" path="/data"/></Directory>'
+                                  .format(section['section_id'], media_type, quoteattr(section['section_name']),
+                                          media_type, section['section_id'], section['section_id'])
+                                  for section, media_type in sections)
+            return 200, 'application/xml', '<MediaContainer size="2">{}</MediaContainer>'.format(directories).encode()
+        for section, media_type in sections:
+            if path == '/library/sections/{}/all'.format(section['section_id']):
+                items = self.library[media_type]
+                updated_since = query.get('updatedAt>>')
+                if updated_since is not None:
+                    items = [item for item in items if item['added_at'] >= int(updated_since)]
+                page = self.page(items, query, headers)
+                if wants_json:
+                    excluded = set(query.get('excludeFields', '').split(',')) | set(query.get('excludeElements', '').split(','))
+                    metadata = [{name: value for name, value in plex_json_item(item, media_type).items() if name not in excluded}
+                                for item in page]
+                    body = {'MediaContainer': {'size': len(page), 'totalSize': len(items), 'Metadata': metadata}}
+                    return 200, 'application/json', json.dumps(body).encode()
+                return 200, 'application/xml', '<MediaContainer size="{}" totalSize="{}" librarySectionID="{}">{}</MediaContainer>'.format(
+                    len(page), len(items), section['section_id'], ''.join(plex_xml_item(item, media_type) for item in page)).encode()
+        if path == '/status/sessions/history/all':
+            page = self.page(self.history, query, headers)
+            return 200, 'application/xml', '<MediaContainer size="{}" totalSize="{}">{}</MediaContainer>'.format(
+                len(page), len(self.history), ''.join(plex_xml_history_entry(entry) for entry in page)).encode()
+        return 404, 'application/xml', b'<MediaContainer size="0"/>'
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are separate writes, with Nagle every small response waits for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def respond(self, method):
+            url = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            status, content_type, body = service.handle(method, url.path, query, self.headers)
+            service.record(body)
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.respond('GET')
+
+        def do_DELETE(self):
+            self.respond('DELETE')
+
+        def do_POST(self):
+            self.respond('POST')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_fake_services(items, seed):
+    logging.info('📦 Generating a synthetic library of {} items'.format(items))
+    library = generate_library(items, seed)
+    history = generate_history(library)
+
+    services = {
+        'plex': FakePlex('plex', library, history),
+        'radarr': FakeArr('radarr', library, history, 'movie', 'movie', radarr_movie),
+        'sonarr': FakeArr('sonarr', library, history, 'series', 'show', sonarr_series),
+        'tautulli': FakeTautulli('tautulli', library, history),
+        'overseerr': FakeOverseerr('overseerr', library, history),
+    }
+
+    for name, service in services.items():
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(service))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        os.environ['{}_URL'.format(name.upper())] = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    for variable in ('PLEX_TOKEN', 'RADARR_APIKEY', 'SONARR_APIKEY', 'TAUTULLI_APIKEY', 'OVERSEERR_APIKEY'):
+        os.environ[variable] = 'benchmark'
+
+    logging.info('✅ Started {} stand-in services'.format(len(services)))
+    return services
+
+
+def load_revision(name):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), REVISIONS[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # The revisions log every item at INFO, keep only their warnings
+    logging.root.setLevel(logging.WARNING)
+    return module
+
+
+class StageRecorder:
+    def __init__(self, revision, services):
+        self.revision = revision
+        self.services = services
+        self.stages = []
+
+    def measure(self, stage, function, *args):
+        before = {name: (service.requests, service.bytes) for name, service in self.services.items()}
+        tracemalloc.start()
+        started = time.perf_counter()
+
+        result = function(*args)
+
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.stages.append({
+            'revision': self.revision,
+            'stage': stage,
+            'seconds': elapsed,
+            'requests': {name: service.requests - before[name][0] for name, service in self.services.items()
+                         if service.requests != before[name][0]},
+            'bytes': sum(service.bytes - before[name][1] for name, service in self.services.items()),
+            'peak_memory': peak,
+            'items': len(result) if hasattr(result, '__len__') else None,
+        })
+        return result
+
+
+def benchmark_revision_1(recorder, cache_directory):
+    module = load_revision('revision-1')
+    module.CACHE_PATH = os.path.join(cache_directory, 'revision-1.sqlite3')
+    module.LAST_WATCHED_INDEX_PATH = os.path.join(cache_directory, 'missing-last-watched-index.json')
+
+    recorder.measure('get_plex_libraries', module.get_plex_libraries)
+    radarr_movie_list = recorder.measure('get_radarr_movies', module.get_radarr_movies)
+    sonarr_series_list = recorder.measure('get_sonarr_series', module.get_sonarr_series)
+    recorder.measure('get_overseerr_requests', module.get_overseerr_requests)
+    tautulli_libraries_table = recorder.measure('get_tautulli_libraries_table', module.get_tautulli_libraries_table)
+    radarr_movie_list = module.remove_radarr_movies_without_files(radarr_movie_list)
+
+    for table_entry in tautulli_libraries_table:
+        library = module.parse_tautulli_libraries_table(table_entry)
+        name = library['section_name']
+        tautulli_media_info = recorder.measure('get_tautulli_library_media_info[{}]'.format(name),
+                                               module.get_tautulli_library_media_info, library)
+        plex_media_info = recorder.measure('get_plex_media_info[{}]'.format(name), module.get_plex_media_info, library)
+        merged_media = recorder.measure('merge_plex_tautulli_media_info[{}]'.format(name),
+                                        module.merge_plex_tautulli_media_info, tautulli_media_info, plex_media_info, library)
+        if library['section_type'] == 'movie':
+            merged_media = recorder.measure('merge_merged_list_radarr_media_info[{}]'.format(name),
+                                            module.merge_merged_list_radarr_media_info, merged_media, radarr_movie_list, library)
+            recorder.measure('filter_merged_list_based_on_remove_limit[{}]'.format(name),
+                             module.filter_merged_list_based_on_remove_limit, merged_media, library)
+        else:
+            merged_media = recorder.measure('merge_merged_list_sonarr_media_info[{}]'.format(name),
+                                            module.merge_merged_list_sonarr_media_info, merged_media, sonarr_series_list, library)
+            recorder.measure('filter_merged_list_based_on_remove_limit[{}]'.format(name),
+                             module.filter_merged_list_based_on_remove_limit, merged_media, library)
+
+    recorder.measure('start (cold cache)', module.start)
+    recorder.measure('start (warm cache)', module.start)
+
+
+def run_startup_probe():
+    """Run revision 3 up to its diskspace check in a new process with every mount above its threshold"""
+    threshold = FREE_SPACE // 1073741824 // 2  # GB
+    output = subprocess.run([sys.executable, '-c', STARTUP_PROBE, REVISIONS['revision-3'], str(threshold)]
+                            + list(STARTUP_DEFERRED_MODULES), cwd=SCRIPT_DIRECTORY, capture_output=True, text=True,
+                            check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def benchmark_revision_3(recorder, cache_directory):
+    probe = recorder.measure('startup (diskspace above threshold)', run_startup_probe)
+    if probe['bytes_to_delete']:
+        raise SystemExit('The startup probe planned a cleanup although every mount is above its threshold')
+    if probe['loaded']:
+        raise SystemExit('The diskspace check loaded {}, they must only be imported once a cleanup runs'
+                         .format(', '.join(probe['loaded'])))
+    if recorder.stages[-1]['seconds'] > STARTUP_BUDGET:
+        raise SystemExit('The diskspace check took {:.2f} seconds, over the startup budget of {} seconds'
+                         .format(recorder.stages[-1]['seconds'], STARTUP_BUDGET))
+
+    module = load_revision('revision-3')
+    module.DRY_RUN = True
+    module.PLEX_LIBRARY_NAMES = [MOVIES_SECTION['section_name'], SHOWS_SECTION['section_name']]
+    module.LAST_WATCHED_INDEX_PATH = os.path.join(cache_directory, 'revision-3-last-watched-index.json')
+
+    diskspace = recorder.measure('get_diskspace', module.get_diskspace, module.SERVICE_TO_CHECK_FREE_DISKSPACE)
+    bytes_to_delete = module.check_diskspace(diskspace, module.SERVICE_TO_CHECK_FREE_DISKSPACE, module.FREE_SPACE_THRESHOLDS)
+    recorder.measure('get_radarr_movies', module.get_radarr_movies, 0)
+    recorder.measure('get_sonarr_shows', module.get_sonarr_shows, 0)
+    plex = recorder.measure('setup_server', module.setup_server, *module.PLEX_SERVERS[0])
+    for fast_loader, loader in ((False, 'plexapi'), (True, 'fast XML loader')):
+        module.PLEX_FAST_LOADER = fast_loader
+        for library_name in module.PLEX_LIBRARY_NAMES:
+            recorder.measure('get_plex_libraries_metadata[{}] ({})'.format(library_name, loader),
+                             module.get_plex_libraries_metadata, plex, library_name)
+        recorder.measure('get_plex_history ({})'.format(loader), module.get_plex_history, plex)
+    candidates = recorder.measure('build_candidates', module.build_candidates)
+    policy_candidates = (candidates * (POLICY_ITEMS // max(len(candidates), 1) + 1))[:POLICY_ITEMS]
+    policy_columns = recorder.measure('build_score_columns ({} items)'.format(len(policy_candidates)),
+                                      module.build_score_columns, policy_candidates)
+    scores, protected = recorder.measure('score_media_candidates ({} items, weighted policy)'.format(len(policy_candidates)),
+                                         module.score_media_candidates, policy_columns, time.time(), POLICY_WEIGHTS,
+                                         module.OVERSEERR_PROTECTION_DAYS, module.RETENTION_REQUEST_DECAY_DAYS)
+    for minimize_overshoot in (False, True):
+        module.PLAN_MINIMIZE_OVERSHOOT = minimize_overshoot
+        recorder.measure('plan_cleanup ({} items{})'.format(len(policy_candidates), ', minimized overshoot' if minimize_overshoot else ''),
+                         lambda: module.plan_cleanup(module.iter_ranked_candidates(policy_candidates, scores, ~protected),
+                                                     bytes_to_delete))
+    module.PLAN_MINIMIZE_OVERSHOOT = False
+    recorder.measure('start (dry run)', module.start, bytes_to_delete)
+
+
+def print_report(stages):
+    print('{:<11} {:<52} {:>9} {:>9} {:>11} {:>11} {:>8}'.format(
+        'revision', 'stage', 'seconds', 'requests', 'MB', 'peak MB', 'items'))
+    for stage in stages:
+        print('{:<11} {:<52} {:>9.3f} {:>9} {:>11.1f} {:>11.1f} {:>8}'.format(
+            stage['revision'], stage['stage'][:52], stage['seconds'], sum(stage['requests'].values()),
+            stage['bytes'] / 1048576, stage['peak_memory'] / 1048576,
+            '' if stage['items'] is None else stage['items']))
+
+
+BENCHMARKS = {
+    'revision-1': benchmark_revision_1,
+    'revision-3': benchmark_revision_3,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the media manager revisions against local stand-in services')
+    parser.add_argument('--items', type=int, default=10000, help='number of synthetic movies and shows (1000 to 200000)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic library')
+    parser.add_argument('--revision', choices=sorted(BENCHMARKS), action='append',
+                        help='revision to benchmark, may be repeated (default: all)')
+    parser.add_argument('--output', help='also write the measurements to this JSON file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    services = start_fake_services(args.items, args.seed)
+
+    stages = []
+    with tempfile.TemporaryDirectory() as cache_directory:
+        for revision in args.revision or sorted(BENCHMARKS):
+            recorder = StageRecorder(revision, services)
+            try:
+                BENCHMARKS[revision](recorder, cache_directory)
+            except ImportError as e:
+                print('Skipping {}, a dependency is missing: {}'.format(revision, e))
+            stages.extend(recorder.stages)
+
+    print_report(stages)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'items': args.items, 'seed': args.seed, 'stages': stages}, f, indent=2)
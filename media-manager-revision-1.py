@@ -8,14 +8,23 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import datetime
+import json
 import logging
 import re
-from datetime import time
+import sqlite3
+import threading
+import time
 
-import requests
 from os import environ
 from dotenv import load_dotenv
 
+from media_manager_common import (
+    RECORD_PATH, REPLAY_PATH, MediaCandidate, apply_overseerr_request_index, build_overseerr_request_index,
+    build_score_columns, current_time, fetch_concurrently, fetch_pages_concurrently, get_session, instrumented, iter_json_array,
+    load_recording, project_overseerr_request, recording, reset_metrics, save_recording, score_media_candidates,
+    write_metrics,
+)
+
 load_dotenv()
 
 # EDIT PARAMETERS IN .env FILE #
@@ -35,6 +44,45 @@ LIBRARY_NAMES = ['Movies', 'TV Shows', 'Animation', 'Series']
 REMOVE_LIMIT = 365*3  # Days
 DRY_RUN = True
 
+FETCH_TIMEOUTS = {  # Seconds per service before its fetch is given up on
+    'plex': 120,
+    'radarr': 120,
+    'sonarr': 120,
+    'tautulli': 300,
+    'overseerr': 120,
+}
+
+TAUTULLI_PAGE_SIZE = 1000
+TAUTULLI_INCREMENTAL_PAGE_SIZE = 50  # First page of an incremental refresh, doubled up to TAUTULLI_PAGE_SIZE
+PLEX_PAGE_SIZE = 1000  # Items per Plex section listing page
+PLEX_EXCLUDE_FIELDS = ('summary', 'tagline', 'studio', 'contentRating', 'originalTitle', 'titleSort', 'thumb', 'art',
+                       'theme', 'audienceRatingImage', 'originallyAvailableAt',
+                       'chapterSource', 'primaryExtraKey')  # Never used, left out of the section listings
+PLEX_EXCLUDE_ELEMENTS = ('Genre', 'Country', 'Director', 'Writer', 'Role', 'Producer', 'Collection', 'Label', 'Image',
+                         'UltraBlurColors', 'Field', 'Rating')
+OVERSEERR_PAGE_SIZE = 500
+OVERSEERR_PROTECTION_DAYS = 90  # Days a requested title is kept regardless of REMOVE_LIMIT
+RETENTION_WEIGHTS = {  # Score per unit of each factor, items scoring above REMOVE_LIMIT are removed
+    'age': 1.0,  # Per day since last played, or added when never played
+    'size': 0.0,  # Per GB on disk
+    'play_count': 0.0,  # Per play, use a negative weight to keep popular titles longer
+    'rating': 0.0,  # Per rating point above 5 out of 10, use a negative weight to keep well rated titles longer
+    'requested': 0.0,  # Scaled by how recent the latest Overseerr request is, 1 right after the request
+}
+RETENTION_REQUEST_DECAY_DAYS = 90  # Days for the request factor to fall to about a third
+
+CACHE_PATH = environ.get('CACHE_PATH', 'media-manager-cache.sqlite3')
+LAST_WATCHED_INDEX_PATH = environ.get('LAST_WATCHED_INDEX_PATH', 'last-watched-index.json')  # Kept by revision 3 webhooks
+CACHE_FULL_RESYNC_HOURS = 24  # Hours between forced full downloads of every cached source
+
+METRICS_REVISION = '1'
+
+# Several instances separated by commas are only supported by revision 3
+for name, url in (('PLEX_URL', PLEX_URL), ('RADARR_URL', RADARR_URL), ('SONARR_URL', SONARR_URL),
+                  ('OVERSEERR_URL', OVERSEERR_URL), ('TAUTULLI_URL', TAUTULLI_URL)):
+    if url and ',' in url:
+        raise ValueError('{} lists several URLs, revision 1 supports a single instance per service'.format(name))
+
 headers = {
     'Accept': 'application/json'
 }
@@ -42,9 +90,13 @@ headers = {
 logging.root.setLevel(logging.NOTSET)
 logging.basicConfig(level=logging.INFO)
 
+cache = None
+cache_lock = threading.Lock()
+
 # CODE BELOW #
 
 
+@instrumented
 def get_plex_libraries():
     logging.info('📦 Retrieving Plex libraries from Plex endpoint')
 
@@ -54,7 +106,7 @@ def get_plex_libraries():
     }
 
     try:
-        r = requests.get(PLEX_URL.rstrip('/') + '/library/sections/', params=payload, headers=headers)
+        r = get_session('plex').get(PLEX_URL.rstrip('/') + '/library/sections/', params=payload, headers=headers)
         response = r.json()
         logging.debug('get_plex_libraries response: ' + str(response))
 
@@ -77,20 +129,44 @@ def parse_plex_library_result(payload):
 
     return result
 
-def get_plex_media_info(parsed_tautulli_library):
-    logging.info('📦 Retrieving Plex media info from Plex endpoint')
-
+def iter_plex_media_info(parsed_tautulli_library, updated_since=None):
+    """Yield the compact record of every item in a Plex section, one listing page at a time"""
     payload = {
-        'X-Plex-Token': PLEX_TOKEN
+        'X-Plex-Token': PLEX_TOKEN,
+        'X-Plex-Container-Size': PLEX_PAGE_SIZE,
+        'includeGuids': 1,
+        'excludeFields': ','.join(PLEX_EXCLUDE_FIELDS),
+        'excludeElements': ','.join(PLEX_EXCLUDE_ELEMENTS),
     }
+    if updated_since is not None:
+        payload['updatedAt>>'] = updated_since
+
+    start = 0
+    while True:
+        payload['X-Plex-Container-Start'] = start
+        r = get_session('plex').get(PLEX_URL.rstrip('/') + '/library/sections/{0}/all'.format(parsed_tautulli_library['section_id']), params=payload, headers=headers)
+        r.raise_for_status()
+        container = r.json()['MediaContainer']
+        page = container.get('Metadata', [])
+
+        # Only the compact records outlive the page
+        for plex_media in page:
+            yield normalize_plex_media(plex_media)
+
+        start += len(page)
+        if len(page) < PLEX_PAGE_SIZE or start >= int(container.get('totalSize', start)):
+            return
+
+
+@instrumented
+def get_plex_media_info(parsed_tautulli_library, updated_since=None):
+    logging.info('📦 Retrieving Plex media info from Plex endpoint')
 
     try:
-        r = requests.get(PLEX_URL.rstrip('/') + '/library/sections/{0}/all'.format(parsed_tautulli_library['section_id']), params=payload, headers=headers)
-        response = r.json()
-        logging.debug('get_plex_media_info response: ' + str(response))
+        res_data = list(iter_plex_media_info(parsed_tautulli_library, updated_since))
+        logging.debug('get_plex_media_info response: ' + str(res_data))
 
-        res_data = response['MediaContainer']['Metadata']
-        if len(res_data) == 0:
+        if len(res_data) == 0 and updated_since is None:
             logging.warning('🚧 No Plex media info found for library {}'.format(parsed_tautulli_library['section_name']))
         else:
             logging.info('✅ Retrieved {} {} media info from Plex'.format(len(res_data), parsed_tautulli_library['section_name']))
@@ -99,6 +175,18 @@ def get_plex_media_info(parsed_tautulli_library):
         logging.error('❌ Plex API \'get_libraries\' request failed: {0}'.format(e))
 
 
+def get_plex_section_size(parsed_tautulli_library):
+    payload = {
+        'X-Plex-Token': PLEX_TOKEN,
+        'X-Plex-Container-Start': 0,
+        'X-Plex-Container-Size': 0
+    }
+
+    r = get_session('plex').get(PLEX_URL.rstrip('/') + '/library/sections/{0}/all'.format(parsed_tautulli_library['section_id']), params=payload, headers=headers)
+    return int(r.json()['MediaContainer']['totalSize'])
+
+
+@instrumented
 def get_radarr_movies():
     logging.info('📦 Retrieving Radarr movies from Radarr endpoint')
 
@@ -107,9 +195,11 @@ def get_radarr_movies():
     }
 
     try:
-        r = requests.get(RADARR_URL.rstrip('/') + '/api/v3/movie', params=payload)
-        response = r.json()
-        logging.debug('get_radarr_movies response: ' + str(response))
+        with get_session('radarr').get(RADARR_URL.rstrip('/') + '/api/v3/movie', params=payload, stream=True) as r:
+            r.raise_for_status()
+            # Only the fields the cleanup uses are kept while the array is decoded
+            response = [normalize_radarr_movie(item) for item in iter_json_array(r)]
+        logging.debug('get_radarr_movies response: %s', response)
 
         if len(response) == 0:
             logging.warning('🚧 No Radarr movies found')
@@ -137,6 +227,7 @@ def remove_radarr_movies_without_files(radarr_movie_list):
     return radarr_movie_list
 
 
+@instrumented
 def get_sonarr_series():
     logging.info('📦 Retrieving Sonarr series from Sonarr endpoint')
 
@@ -145,9 +236,11 @@ def get_sonarr_series():
     }
 
     try:
-        r = requests.get(SONARR_URL.rstrip('/') + '/api/v3/series', params=payload)
-        response = r.json()
-        logging.debug('get_sonarr_series response: ' + str(response))
+        with get_session('sonarr').get(SONARR_URL.rstrip('/') + '/api/v3/series', params=payload, stream=True) as r:
+            r.raise_for_status()
+            # Only the fields the cleanup uses are kept while the array is decoded
+            response = [normalize_sonarr_series(item) for item in iter_json_array(r)]
+        logging.debug('get_sonarr_series response: %s', response)
 
         if len(response) == 0:
             logging.warning('🚧 No Sonarr series found')
@@ -159,38 +252,41 @@ def get_sonarr_series():
         logging.error('❌ Sonarr API \'series\' request failed: {0}'.format(e))
 
 
+@instrumented
 def get_overseerr_requests():
     logging.info('📦 Retrieving Overseerr media from Overseerr endpoint')
 
-    payload = {
-        'take': 20,
-        'skip': 0,
-        'sort': 'added'
-    }
-
     headers = {
         'X-Api-Key': OVERSEERR_APIKEY,
     }
 
+    def fetch_page(skip):
+        payload = {
+            'take': OVERSEERR_PAGE_SIZE,
+            'skip': skip,
+            'sort': 'added'
+        }
+        r = get_session('overseerr').get(OVERSEERR_URL.rstrip('/') + '/api/v1/request', params=payload, headers=headers)
+        r.raise_for_status()
+        page = r.json()
+        # Only the fields the request index uses are kept from every page
+        page['results'] = [project_overseerr_request(result) for result in page['results']]
+        return page
+
     try:
-        r = requests.get(OVERSEERR_URL.rstrip('/') + '/api/v1/request',params=payload, headers=headers)
-        response = r.json()
+        response = fetch_page(0)
         logging.debug('get_overseerr_requests response: ' + str(response))
 
-        results = response['pageInfo']['results']
-        res_data = response['results']
-        while results > payload['skip']:
-            payload['skip'] = payload['skip'] + 20
-            r = requests.get(OVERSEERR_URL.rstrip('/') + '/api/v1/request', params=payload, headers=headers)
-            response = r.json()
-            for result in response['results']:
-                res_data.append(result)
+        pages = fetch_pages_concurrently(fetch_page, response, response['pageInfo']['results'], OVERSEERR_PAGE_SIZE)
+        res_data = [result for page in pages for result in page['results']]
 
         logging.info('✅ Retrieved {} requests from Overseerr'.format(len(res_data)))
         return res_data
     except Exception as e:
         logging.error('❌ Overseerr API \'request\' request failed: {0}'.format(e))
 
+
+@instrumented
 def get_tautulli_libraries_table():
     logging.info('📦 Retrieving Tautulli libraries from Tautulli endpoint')
 
@@ -200,7 +296,7 @@ def get_tautulli_libraries_table():
     }
 
     try:
-        r = requests.get(TAUTULLI_URL.rstrip('/') + '/api/v2', params=payload)
+        r = get_session('tautulli').get(TAUTULLI_URL.rstrip('/') + '/api/v2', params=payload)
         response = r.json()
 
         res_data = response['response']['data']['data']
@@ -230,34 +326,37 @@ def parse_tautulli_libraries_table(payload):
     return result
 
 
-def get_tautulli_library_media_info(tautulli_library):
-    logging.info('📦 Retrieving Tautulli library {} media info'.format(tautulli_library['section_name']))
-
+def get_tautulli_library_media_page(tautulli_library, start, order_column='last_played', length=TAUTULLI_PAGE_SIZE):
     payload = {
         'apikey': TAUTULLI_APIKEY,
         'cmd': 'get_library_media_info',
         'section_id': tautulli_library['section_id'],
-        'order_column': 'last_played',
+        'order_column': order_column,
         'order_dir': 'desc',
-        'length': 100,
-        'start': 0
+        'length': length,
+        'start': start
     }
+    r = get_session('tautulli').get(TAUTULLI_URL.rstrip('/') + '/api/v2', params=payload)
+    return r.json()['response']['data']
 
-    res_data = []
+
+@instrumented
+def get_tautulli_library_media_info(tautulli_library):
+    logging.info('📦 Retrieving Tautulli library {} media info'.format(tautulli_library['section_name']))
+
+    def fetch_page(start):
+        return get_tautulli_library_media_page(tautulli_library, start)
 
     try:
-        while payload['start'] < tautulli_library['count']:
-            r = requests.get(TAUTULLI_URL.rstrip('/') + '/api/v2', params=payload)
-            response = r.json()
+        response = fetch_page(0)
+        total = response.get('recordsFiltered', tautulli_library['count'])
 
-            logging.debug('get_tautulli_library_media_info response: ' + str(res_data))
+        pages = fetch_pages_concurrently(fetch_page, response, total, TAUTULLI_PAGE_SIZE)
+        res_data = [media for page in pages for media in page['data']]
+        logging.debug('get_tautulli_library_media_info response: ' + str(res_data))
 
-            if len(response['response']['data']['data']) == 0:
-                logging.warning('🚧 No Tautulli library {} media found'.format(tautulli_library['section_name']))
-            else:
-                for media in response['response']['data']['data']:
-                    res_data.append(media)
-            payload['start'] = payload['start'] + 100
+        if len(res_data) == 0:
+            logging.warning('🚧 No Tautulli library {} media found'.format(tautulli_library['section_name']))
 
         logging.info('✅ Retrieved {} {} media info from Tautulli'.format(len(res_data), tautulli_library['section_name']))
         return res_data
@@ -265,149 +364,663 @@ def get_tautulli_library_media_info(tautulli_library):
         logging.error("❌ Tautulli API 'get_tautulli_library_media_info' request failed: {0}".format(e))
 
 
+def build_tautulli_media_index(tautulli_media_info):
+    rating_key_index = {}
+    title_year_index = {}
+    title_index = {}
+
+    for tautulli_media in tautulli_media_info:
+        name = reformat_name(tautulli_media['title'])
+        rating_key_index[str(tautulli_media['rating_key'])] = tautulli_media
+
+        title_year = (name, str(tautulli_media.get('year') or ''))
+        if title_year in title_year_index:
+            logging.warning('🚧 Duplicate Tautulli title {} ({}), matching by rating key only'
+                            .format(tautulli_media['title'], title_year[1]))
+            title_year_index[title_year] = None
+        else:
+            title_year_index[title_year] = tautulli_media
+
+        # Ambiguous titles are kept as None so they never silently match the wrong item
+        title_index[name] = None if name in title_index else tautulli_media
+
+    return rating_key_index, title_year_index, title_index
+
+
+def find_tautulli_media(plex_media, tautulli_media_index):
+    rating_key_index, title_year_index, title_index = tautulli_media_index
+
+    tautulli_media = rating_key_index.get(str(plex_media.get('ratingKey')))
+    if tautulli_media is not None:
+        return tautulli_media
+
+    name = reformat_name(plex_media['title'])
+    title_year = (name, str(plex_media.get('year') or ''))
+    if title_year in title_year_index:
+        return title_year_index[title_year]
+    return title_index.get(name)
+
+
+@instrumented
 def merge_plex_tautulli_media_info(tautulli_media_info, plex_media_info, library):
     logging.info('📦 Merging {} Plex and Tautulli media info'.format(library['section_name']))
     merged_media_info = []
+    matched_rating_keys = set()
+    unmatched = 0
 
-    for plex_media in plex_media_info:
-        for tautulli_media in tautulli_media_info:
-            if reformat_name(tautulli_media['title']) == reformat_name(plex_media['title']):
-                if library['section_type'] == 'movie':
-                    merged_media_info.append(merge_plex_tautulli_movie_media_info(tautulli_media, plex_media))
-                elif library['section_type'] == 'show':
-                    merged_media_info.append(merge_plex_tautulli_show_media_info(tautulli_media, plex_media))
+    tautulli_media_index = build_tautulli_media_index(tautulli_media_info)
 
+    for plex_media in plex_media_info:
+        tautulli_media = find_tautulli_media(plex_media, tautulli_media_index)
+        if tautulli_media is None:
+            unmatched += 1
+            logging.debug('🚧 No Tautulli media info found for {}'.format(plex_media['title']))
+            continue
+
+        if tautulli_media['rating_key'] in matched_rating_keys:
+            logging.warning('🚧 Tautulli media {} matched more than one Plex item, skipping {}'
+                            .format(tautulli_media['title'], plex_media['title']))
+            continue
+        matched_rating_keys.add(tautulli_media['rating_key'])
+
+        if library['section_type'] == 'movie':
+            merged_media_info.append(merge_plex_tautulli_movie_media_info(tautulli_media, plex_media))
+        elif library['section_type'] == 'show':
+            merged_media_info.append(merge_plex_tautulli_show_media_info(tautulli_media, plex_media))
+
+    if unmatched > 0:
+        logging.warning('🚧 {} {} Plex items have no matching Tautulli media info'.format(unmatched, library['section_name']))
 
     logging.debug('merge_plex_tautulli_media_info response: ' + str(merged_media_info))
     logging.info('✅ Merged {} Plex and Tautulli media info'.format(library['section_name']))
     return merged_media_info
 
 
+REFORMAT_NAME_PATTERN = re.compile('[^a-zA-Z0-9\n\.]')
+
+
 def reformat_name(name):
     name = name.lower()
-    name = re.sub('[^a-zA-Z0-9\n\.]', '', name)
+    name = REFORMAT_NAME_PATTERN.sub('', name)
     return name
 
 
+PLEX_GUID_ID_TYPES = {'imdb': 'imdbId', 'tmdb': 'tmdbId', 'tvdb': 'tvdbId'}
+
+
+def get_plex_external_ids(plex_media):
+    external_ids = {}
+    for guid in plex_media.get('Guid', []):
+        agent, _, external_id = guid['id'].partition('://')
+        if agent in PLEX_GUID_ID_TYPES and external_id:
+            external_ids[PLEX_GUID_ID_TYPES[agent]] = external_id
+    return external_ids
+
+
+def get_plex_rating(plex_media):
+    rating = plex_media.get('audienceRating', plex_media.get('rating'))
+    return float(rating) if rating is not None else None
+
+
 def merge_plex_tautulli_movie_media_info(tautulli_media, plex_media):
-    result = {
-        'title': plex_media['title'],
-        'rating_key': tautulli_media['rating_key'],
-        'added_at': tautulli_media['added_at'],
-        'last_played': tautulli_media['last_played'],
-        'file_size': tautulli_media['file_size'],
-        'file_name': plex_media['Media'][0]['Part'][0]['file'].rsplit('/', 1)[-1],
-    }
+    external_ids = get_plex_external_ids(plex_media)
+    result = MediaCandidate(
+        rating_key=tautulli_media['rating_key'],
+        type='movie',
+        title=plex_media['title'],
+        imdb_id=external_ids.get('imdbId'),
+        tmdb_id=external_ids.get('tmdbId'),
+        added_at=int(tautulli_media['added_at']),
+        last_viewed_at=int(tautulli_media['last_played']) if tautulli_media['last_played'] else None,
+        size=int(tautulli_media['file_size'] or 0),
+        play_count=int(tautulli_media.get('play_count') or 0),
+        rating=get_plex_rating(plex_media),
+        path=plex_media['Media'][0]['Part'][0]['file'],
+    )
     logging.debug('merge_plex_tautulli_movie_media_info response: ' + str(result))
     return result
 
 
 def merge_plex_tautulli_show_media_info(tautulli_media, plex_media):
-    result = {
-        'title': plex_media['title'],
-        'rating_key': plex_media['ratingKey'],
-        'added_at': tautulli_media['added_at'],
-        'last_played': tautulli_media['last_played'],
-        'file_size': tautulli_media['file_size'],
-
-    }
+    external_ids = get_plex_external_ids(plex_media)
+    result = MediaCandidate(
+        rating_key=plex_media['ratingKey'],
+        type='show',
+        title=plex_media['title'],
+        imdb_id=external_ids.get('imdbId'),
+        tmdb_id=external_ids.get('tmdbId'),
+        tvdb_id=external_ids.get('tvdbId'),
+        added_at=int(tautulli_media['added_at']),
+        last_viewed_at=int(tautulli_media['last_played']) if tautulli_media['last_played'] else None,
+        size=int(tautulli_media['file_size'] or 0),
+        play_count=int(tautulli_media.get('play_count') or 0),
+        rating=get_plex_rating(plex_media),
+        path=plex_media['Location'][0]['path'] if 'Location' in plex_media else None,
+    )
     logging.debug('merge_plex_tautulli_movie_media_info response: ' + str(result))
     return result
 
 
-def merge_merged_list_radarr_media_info(merged_list, radarr_movie_list):
+@instrumented
+def build_radarr_file_index(radarr_movie_list):
+    """Index Radarr movies by the absolute and the relative path of their movie file and by their external ids"""
+    radarr_file_index = {}
+
+    for radarr_item in radarr_movie_list:
+        movie_file = radarr_item.get('movieFile') or {}
+        if movie_file.get('path'):
+            radarr_file_index[('path', movie_file['path'])] = radarr_item
+        if movie_file.get('relativePath'):
+            radarr_file_index.setdefault(('relativePath', movie_file['relativePath']), radarr_item)
+        for id_type in ('tmdbId', 'imdbId'):
+            if radarr_item.get(id_type):
+                radarr_file_index.setdefault((id_type, str(radarr_item[id_type])), radarr_item)
+
+    return radarr_file_index
+
+
+def find_radarr_movie(merged_item, radarr_file_index):
+    # Plex and Radarr only agree on the absolute path when they mount the media at the same place,
+    # renamed files are still found through the Plex GUIDs
+    radarr_item = radarr_file_index.get(('path', merged_item.path))
+    if radarr_item is None:
+        radarr_item = radarr_file_index.get(('relativePath', merged_item.path.rsplit('/', 1)[-1]))
+    for id_type, external_id in (('tmdbId', merged_item.tmdb_id), ('imdbId', merged_item.imdb_id)):
+        if radarr_item is None and external_id:
+            radarr_item = radarr_file_index.get((id_type, external_id))
+    return radarr_item
+
+
+@instrumented
+def build_sonarr_path_index(sonarr_series_list):
+    """Index Sonarr series by their root folder and, for differently mounted libraries, by its name and tvdb id"""
+    sonarr_path_index = {}
+
+    for sonarr_item in sonarr_series_list:
+        if sonarr_item.get('path'):
+            path = sonarr_item['path'].rstrip('/')
+            sonarr_path_index[('path', path)] = sonarr_item
+            sonarr_path_index.setdefault(('folder', path.rsplit('/', 1)[-1]), sonarr_item)
+        if sonarr_item.get('tvdbId'):
+            sonarr_path_index.setdefault(('tvdbId', str(sonarr_item['tvdbId'])), sonarr_item)
+
+    return sonarr_path_index
+
+
+def find_sonarr_series(merged_item, sonarr_path_index):
+    """Return the series whose root folder contains the path of merged_item, a show folder or any episode file"""
+    # Every parent directory is a single lookup, so resolving a path costs one pass over its length
+    directory = (merged_item.path or '').rstrip('/')
+    while directory:
+        sonarr_item = sonarr_path_index.get(('path', directory))
+        if sonarr_item is not None:
+            return sonarr_item
+        directory = directory.rsplit('/', 1)[0] if '/' in directory else ''
+
+    sonarr_item = None
+    if merged_item.path:
+        sonarr_item = sonarr_path_index.get(('folder', merged_item.path.rstrip('/').rsplit('/', 1)[-1]))
+    if sonarr_item is None and merged_item.tvdb_id:
+        sonarr_item = sonarr_path_index.get(('tvdbId', merged_item.tvdb_id))
+    return sonarr_item
+
+
+@instrumented
+def merge_merged_list_radarr_media_info(merged_list, radarr_movie_list, library):
     logging.info('📦 Merging {} merged list and Radarr media info'.format(library['section_name']))
     merged_media_info = []
+    radarr_file_index = build_radarr_file_index(radarr_movie_list)
 
     for merged_item in merged_list:
-        for radarr_item in radarr_movie_list:
-
-            if merged_item['file_name'] == radarr_item['movieFile']['relativePath']:
-                merged_item['tmdb_id'] = radarr_item['tmdbId']
-                merged_item['imdb_id'] = radarr_item['imdbId']
-                merged_item['radarr_id'] = radarr_item['id']
-                merged_media_info.append(merged_item)
-                break
+        radarr_item = find_radarr_movie(merged_item, radarr_file_index)
+        if radarr_item is not None:
+            merged_item.tmdb_id = radarr_item['tmdbId']
+            merged_item.imdb_id = radarr_item['imdbId']
+            merged_item.arr_id = radarr_item['id']
+            merged_media_info.append(merged_item)
     logging.info('✅ Merged {} merged list and Radarr media info'.format(library['section_name']))
     return merged_media_info
 
 
-def merge_merged_list_sonarr_media_info(merged_list, sonarr_series_list):
+@instrumented
+def merge_merged_list_sonarr_media_info(merged_list, sonarr_series_list, library):
     logging.info('📦 Merging {} merged list and Sonarr media info'.format(library['section_name']))
     merged_media_info = []
-    # for merged_item in merged_list:
-        # for sonarr_item in sonarr_series_list:
+    sonarr_path_index = build_sonarr_path_index(sonarr_series_list)
+
+    for merged_item in merged_list:
+        sonarr_item = find_sonarr_series(merged_item, sonarr_path_index)
+        if sonarr_item is not None:
+            merged_item.tvdb_id = sonarr_item['tvdbId']
+            merged_item.tmdb_id = sonarr_item.get('tmdbId')
+            merged_item.imdb_id = sonarr_item['imdbId']
+            merged_item.arr_id = sonarr_item['id']
+            merged_media_info.append(merged_item)
+    logging.info('✅ Merged {} merged list and Sonarr media info'.format(library['section_name']))
+    return merged_media_info
 
 
-def filter_merged_list_based_on_remove_limit(merged_media_info):
-    logging.info('📦 Filtering {} merged list based on remove limit'.format(library['section_name']))
+def load_last_watched_index():
+    try:
+        with open(LAST_WATCHED_INDEX_PATH) as f:
+            return {str(rating_key): viewed_at for rating_key, viewed_at in json.load(f)['items'].items()}
+    except FileNotFoundError:
+        return {}
 
-    remove_list = []
 
+def apply_last_watched_index(merged_media_info, last_watched_index):
+    """Plays recorded by webhooks since Tautulli was last swept override its last_played"""
     for media in merged_media_info:
-        if media['last_played'] is None:
-            date_to = datetime.datetime.fromtimestamp(int(media['added_at']))
-        else:
-            date_to = datetime.datetime.fromtimestamp(int(media['last_played']))
+        viewed_at = last_watched_index.get(str(media.rating_key))
+        if viewed_at and viewed_at > (media.last_viewed_at or 0):
+            media.last_viewed_at = viewed_at
+    return merged_media_info
+
 
-        date_from = datetime.datetime.now()
+def filter_merged_list_based_on_remove_limit(merged_media_info, library):
+    logging.info('📦 Filtering {} merged list based on remove limit'.format(library['section_name']))
 
-        if (date_from - date_to).days > REMOVE_LIMIT:
-            remove_list.append(media)
+    if not merged_media_info:
+        logging.info('✅ Filtered {} merged list based on remove limit'.format(library['section_name']))
+        return []
 
+    scores, protected = score_media_candidates(build_score_columns(merged_media_info), current_time(),
+                                               RETENTION_WEIGHTS, OVERSEERR_PROTECTION_DAYS, RETENTION_REQUEST_DECAY_DAYS)
+    expired = scores > REMOVE_LIMIT
+    remove_list = [merged_media_info[index] for index in (expired & ~protected).nonzero()[0]]
+
+    kept = int((expired & protected).sum())
+    if kept:
+        logging.info('🛡️ Kept {} {} items requested in the last {} days'.format(
+            kept, library['section_name'], OVERSEERR_PROTECTION_DAYS))
     logging.info('✅ Filtered {} merged list based on remove limit'.format(library['section_name']))
     return remove_list
 
 
-# Plex logic
-parsed_plex_libraries = []
-plex_libraries = get_plex_libraries()
+def open_cache(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('CREATE TABLE IF NOT EXISTS records ('
+                       'source TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (source, key))')
+    connection.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                       'source TEXT PRIMARY KEY, synced_at REAL NOT NULL, full_synced_at REAL NOT NULL, watermark TEXT)')
+    return connection
+
+
+def get_sync_state(source):
+    with cache_lock:
+        row = cache.execute('SELECT synced_at, full_synced_at, watermark FROM sync_state WHERE source = ?',
+                            (source,)).fetchone()
+    if row is None:
+        return None
+    return {'synced_at': row[0], 'full_synced_at': row[1], 'watermark': json.loads(row[2])}
+
+
+def needs_full_resync(sync_state):
+    return sync_state is None or time.time() - sync_state['full_synced_at'] > CACHE_FULL_RESYNC_HOURS * 3600
 
-logging.info('📦 Parsing \'get_plex_libraries\' result')
 
-for library in plex_libraries:
-    parsed_plex_libraries.append(parse_plex_library_result(library))
+def load_cached_records(source):
+    with cache_lock:
+        rows = cache.execute('SELECT data FROM records WHERE source = ?', (source,)).fetchall()
+    return [json.loads(row[0]) for row in rows]
 
-logging.debug('parse_plex_library_result response: ' + str(parsed_plex_libraries))
-logging.info("✅ Parsed {} 'get_plex_libraries' result".format(len(plex_libraries)))
 
-# Radarr logic
-radarr_movie_list = get_radarr_movies()
-radarr_movie_list = remove_radarr_movies_without_files(radarr_movie_list)
+def load_cached_keys(source):
+    with cache_lock:
+        rows = cache.execute('SELECT key FROM records WHERE source = ?', (source,)).fetchall()
+    return {row[0] for row in rows}
 
-# Sonarr logic
-sonarr_series_list = get_sonarr_series()
 
-# Tautulli logic
-tautulli_libraries_table = get_tautulli_libraries_table()
+def store_cached_records(source, records, key, watermark, full, removed_keys=()):
+    """Store records and the sync state of source, returns the number of records cached for it"""
+    now = time.time()
+    with cache_lock, cache:
+        if full:
+            cache.execute('DELETE FROM records WHERE source = ?', (source,))
+        cache.executemany('DELETE FROM records WHERE source = ? AND key = ?',
+                          [(source, str(removed_key)) for removed_key in removed_keys])
+        cache.executemany('INSERT OR REPLACE INTO records (source, key, data) VALUES (?, ?, ?)',
+                          [(source, str(record[key]), json.dumps(record)) for record in records])
 
-parsed_tautulli_libraries_table = []
+        previous = cache.execute('SELECT full_synced_at FROM sync_state WHERE source = ?', (source,)).fetchone()
+        full_synced_at = now if full or previous is None else previous[0]
+        cache.execute('INSERT OR REPLACE INTO sync_state (source, synced_at, full_synced_at, watermark) VALUES (?, ?, ?, ?)',
+                      (source, now, full_synced_at, json.dumps(watermark)))
+        return cache.execute('SELECT COUNT(*) FROM records WHERE source = ?', (source,)).fetchone()[0]
 
-logging.info("📦 Parsing 'get_tautulli_libraries_table' result")
 
-for library in tautulli_libraries_table:
-    result = parse_tautulli_libraries_table(library)
-    if result is not None:
+def normalize_radarr_movie(movie):
+    result = {
+        'id': movie['id'],
+        'title': movie['title'],
+        'tmdbId': movie.get('tmdbId'),
+        'imdbId': movie.get('imdbId'),
+        'path': movie.get('path'),
+    }
+    if 'movieFile' in movie:
+        result['movieFile'] = {
+            'relativePath': movie['movieFile'].get('relativePath'),
+            'path': movie['movieFile'].get('path'),
+        }
+    return result
+
+
+def normalize_sonarr_series(series):
+    return {
+        'id': series['id'],
+        'title': series['title'],
+        'tvdbId': series.get('tvdbId'),
+        'tmdbId': series.get('tmdbId'),
+        'imdbId': series.get('imdbId'),
+        'path': series.get('path'),
+    }
+
+
+def normalize_plex_media(plex_media):
+    result = {
+        'ratingKey': plex_media['ratingKey'],
+        'title': plex_media['title'],
+        'year': plex_media.get('year'),
+        'Guid': [{'id': guid['id']} for guid in plex_media.get('Guid', [])],
+        'audienceRating': plex_media.get('audienceRating'),
+        'rating': plex_media.get('rating'),
+    }
+    if 'Media' in plex_media:
+        result['Media'] = [{'Part': [{'file': plex_media['Media'][0]['Part'][0]['file']}]}]
+    if 'Location' in plex_media:
+        result['Location'] = [{'path': plex_media['Location'][0]['path']}]
+    return result
+
+
+def normalize_tautulli_media(tautulli_media):
+    return {
+        'rating_key': tautulli_media['rating_key'],
+        'title': tautulli_media['title'],
+        'year': tautulli_media.get('year'),
+        'added_at': tautulli_media['added_at'],
+        'last_played': tautulli_media['last_played'],
+        'file_size': tautulli_media['file_size'],
+        'play_count': tautulli_media.get('play_count'),
+    }
+
+
+def get_arr_changed_ids(service, url, apikey, since, id_field):
+    payload = {
+        'apikey': apikey,
+        'date': since,
+    }
+
+    r = get_session(service).get(url.rstrip('/') + '/api/v3/history/since', params=payload)
+    return {record[id_field] for record in r.json() if record.get(id_field)}
+
+
+def get_arr_ids(service, url, apikey, resource):
+    """Return the ids of every Radarr/Sonarr item, the listing is decoded one item at a time and only ids are kept"""
+    payload = {
+        'apikey': apikey,
+    }
+
+    with get_session(service).get(url.rstrip('/') + '/api/v3/{}'.format(resource), params=payload, stream=True) as r:
+        r.raise_for_status()
+        return {item['id'] for item in iter_json_array(r)}
+
+
+def get_arr_item(service, url, apikey, resource, item_id):
+    payload = {
+        'apikey': apikey,
+    }
+
+    r = get_session(service).get(url.rstrip('/') + '/api/v3/{}/{}'.format(resource, item_id), params=payload)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()
+
+
+@instrumented
+def get_cached_arr_items(service, url, apikey, resource, id_field, fetch_all, normalize, library_count):
+    """Refresh the cached Radarr/Sonarr library with the items changed since the last run
+
+    library_count is the number of items in the matching Tautulli libraries, None when unknown.
+    """
+    sync_state = get_sync_state(service)
+    # Sync from the start of this refresh so changes made while it runs are picked up next time
+    synced_from = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    watermark = {'since': synced_from, 'library_count': library_count}
+
+    if needs_full_resync(sync_state):
+        items = fetch_all()
+        if items is None:
+            return None
+        store_cached_records(service, [normalize(item) for item in items], 'id', watermark, full=True)
+    else:
+        since = sync_state['watermark']['since']
+        logging.info('📦 Refreshing cached {} {} changed since {}'.format(service, resource, since))
+        try:
+            changed_ids = get_arr_changed_ids(service, url, apikey, since, id_field)
+            removed_ids = []
+            # The history has no event for deleted items, the whole id listing is only checked when the
+            # libraries changed size and otherwise left to the scheduled full resync
+            if library_count is None or library_count != sync_state['watermark']['library_count']:
+                logging.info('📦 Library size changed, checking the cached {} {} ids'.format(service, resource))
+                current_ids = get_arr_ids(service, url, apikey, resource)
+                cached_ids = {int(key) for key in load_cached_keys(service)}
+                removed_ids = list(cached_ids - current_ids)
+                changed_ids = changed_ids & current_ids | current_ids - cached_ids
+            changed_items = []
+            for item_id in changed_ids:
+                item = get_arr_item(service, url, apikey, resource, item_id)
+                if item is None:
+                    removed_ids.append(item_id)
+                else:
+                    changed_items.append(normalize(item))
+        except Exception as e:
+            logging.error('❌ {} incremental refresh failed, serving cached {}: {}'.format(service, resource, e))
+        else:
+            store_cached_records(service, changed_items, 'id', watermark, full=False, removed_keys=removed_ids)
+            logging.info('✅ Refreshed {} and removed {} cached {} {}'.format(len(changed_items), len(removed_ids), service, resource))
+
+    return load_cached_records(service)
+
+
+def get_cached_radarr_movies(library_count=None):
+    return get_cached_arr_items('radarr', RADARR_URL, RADARR_APIKEY, 'movie', 'movieId',
+                                get_radarr_movies, normalize_radarr_movie, library_count)
+
+
+def get_cached_sonarr_series(library_count=None):
+    return get_cached_arr_items('sonarr', SONARR_URL, SONARR_APIKEY, 'series', 'seriesId',
+                                get_sonarr_series, normalize_sonarr_series, library_count)
+
+
+def get_library_count(tautulli_libraries_table, section_type):
+    return sum(int(library['count'] or 0) for library in tautulli_libraries_table if library['section_type'] == section_type)
+
+
+@instrumented
+def get_cached_plex_media_info(parsed_tautulli_library):
+    source = 'plex:{}'.format(parsed_tautulli_library['section_id'])
+    sync_state = get_sync_state(source)
+    synced_from = int(time.time())
+
+    if not needs_full_resync(sync_state):
+        try:
+            section_size = get_plex_section_size(parsed_tautulli_library)
+            updated_media = get_plex_media_info(parsed_tautulli_library, updated_since=sync_state['watermark']['updated_at'])
+            if updated_media is not None:
+                # Added items show up in the updatedAt filter but removed ones don't, a cache that no longer
+                # holds as many items as the section has drifted
+                cached_size = store_cached_records(source, updated_media, 'ratingKey', {'updated_at': synced_from}, full=False)
+                if cached_size == section_size:
+                    return load_cached_records(source)
+                logging.warning('🚧 Plex library {} changed size, running a full resync'.format(parsed_tautulli_library['section_name']))
+        except Exception as e:
+            logging.error('❌ Plex incremental refresh failed, running a full resync: {}'.format(e))
+
+    plex_media = get_plex_media_info(parsed_tautulli_library)
+    if plex_media is None:
+        return None
+    store_cached_records(source, plex_media, 'ratingKey', {'updated_at': synced_from}, full=True)
+    return load_cached_records(source)
+
+
+def get_tautulli_library_media_since(tautulli_library, order_column, since):
+    """Page through the library newest first until reaching media older than since"""
+    res_data = []
+    start = 0
+    # Few items change between runs, pages start small and grow while they keep holding newer media
+    length = TAUTULLI_INCREMENTAL_PAGE_SIZE
+
+    while True:
+        page = get_tautulli_library_media_page(tautulli_library, start, order_column, length)
+        for media in page['data']:
+            if int(media.get(order_column) or 0) <= since:
+                return res_data, page['recordsFiltered']
+            res_data.append(media)
+        if len(page['data']) < length:
+            return res_data, page['recordsFiltered']
+        start += length
+        length = min(length * 2, TAUTULLI_PAGE_SIZE)
+
+
+def get_tautulli_watermark(tautulli_media_info):
+    return {
+        'last_played': max([int(media['last_played'] or 0) for media in tautulli_media_info] or [0]),
+        'added_at': max([int(media['added_at'] or 0) for media in tautulli_media_info] or [0]),
+    }
+
+
+@instrumented
+def get_cached_tautulli_library_media_info(tautulli_library):
+    source = 'tautulli:{}'.format(tautulli_library['section_id'])
+    sync_state = get_sync_state(source)
+
+    if not needs_full_resync(sync_state):
+        watermark = sync_state['watermark']
+        try:
+            played_media, size = get_tautulli_library_media_since(tautulli_library, 'last_played', watermark['last_played'])
+            added_media, _ = get_tautulli_library_media_since(tautulli_library, 'added_at', watermark['added_at'])
+
+            changed_media = [normalize_tautulli_media(media) for media in played_media + added_media]
+            new_watermark = get_tautulli_watermark(changed_media)
+            new_watermark['last_played'] = max(new_watermark['last_played'], watermark['last_played'])
+            new_watermark['added_at'] = max(new_watermark['added_at'], watermark['added_at'])
+            # Added media is picked up by its added_at, a cache that no longer holds as many items as the library has drifted
+            if store_cached_records(source, changed_media, 'rating_key', new_watermark, full=False) == size:
+                return load_cached_records(source)
+            logging.warning('🚧 Tautulli library {} changed size, running a full resync'.format(tautulli_library['section_name']))
+        except Exception as e:
+            logging.error('❌ Tautulli incremental refresh failed, running a full resync: {}'.format(e))
+
+    tautulli_media = get_tautulli_library_media_info(tautulli_library)
+    if tautulli_media is None:
+        return None
+    normalized_media = [normalize_tautulli_media(media) for media in tautulli_media]
+    store_cached_records(source, normalized_media, 'rating_key', get_tautulli_watermark(normalized_media), full=True)
+    return load_cached_records(source)
+
+
+def start():
+    global cache
+    reset_metrics()
+    if REPLAY_PATH and not recording:
+        load_recording(REPLAY_PATH)
+    # Recorded and replayed runs start from an empty cache so every source is fetched in full, the same way both times
+    cache = open_cache(':memory:' if RECORD_PATH or REPLAY_PATH else CACHE_PATH)
+
+    # Tautulli lists the libraries every later step works through, nothing can be cleaned up without it.
+    # Their sizes also tell the Radarr/Sonarr cache refresh whether items were removed.
+    tautulli_libraries_table = get_tautulli_libraries_table()
+    if tautulli_libraries_table is None:
+        logging.error('❌ Tautulli libraries are unavailable, aborting the run')
+        write_metrics(METRICS_REVISION)
+        save_recording(METRICS_REVISION)
+        return
+
+    upstream = fetch_concurrently({
+        'plex_libraries': ('plex', get_plex_libraries, ()),
+        'radarr_movies': ('radarr', get_cached_radarr_movies, (get_library_count(tautulli_libraries_table, 'movie'),)),
+        'sonarr_series': ('sonarr', get_cached_sonarr_series, (get_library_count(tautulli_libraries_table, 'show'),)),
+        'overseerr_requests': ('overseerr', get_overseerr_requests, ()),
+    }, FETCH_TIMEOUTS)
+
+    # Plex logic
+    parsed_plex_libraries = []
+    plex_libraries = upstream['plex_libraries']
+    if plex_libraries is None:
+        logging.warning('🚧 Plex libraries are unavailable, skipping their parsing')
+        plex_libraries = []
+
+    logging.info('📦 Parsing \'get_plex_libraries\' result')
+
+    for library in plex_libraries:
+        parsed_plex_libraries.append(parse_plex_library_result(library))
+
+    logging.debug('parse_plex_library_result response: ' + str(parsed_plex_libraries))
+    logging.info("✅ Parsed {} 'get_plex_libraries' result".format(len(plex_libraries)))
+
+    # Radarr logic
+    radarr_movie_list = upstream['radarr_movies']
+    if radarr_movie_list is None:
+        logging.warning('🚧 Radarr movies are unavailable, skipping the movie libraries')
+    else:
+        radarr_movie_list = remove_radarr_movies_without_files(radarr_movie_list)
+
+    # Sonarr logic
+    sonarr_series_list = upstream['sonarr_series']
+    if sonarr_series_list is None:
+        logging.warning('🚧 Sonarr series are unavailable, skipping the show libraries')
+
+    # Tautulli logic
+    parsed_tautulli_libraries_table = []
+
+    logging.info("📦 Parsing 'get_tautulli_libraries_table' result")
+
+    for library in tautulli_libraries_table:
+        result = parse_tautulli_libraries_table(library)
+        if result is None:
+            continue
+        # Libraries whose Radarr/Sonarr list is unavailable can't be matched, their media isn't fetched either
+        if (result['section_type'] == 'movie' and radarr_movie_list is None or
+                result['section_type'] == 'show' and sonarr_series_list is None):
+            continue
         parsed_tautulli_libraries_table.append(result)
 
+    logging.debug('parse_tautulli_libraries_table response: ' + str(parsed_tautulli_libraries_table))
+    logging.info("✅ Parsed {} 'get_tautulli_libraries_table' result".format(len(parsed_tautulli_libraries_table)))
+
+    library_tasks = {}
+    for library in parsed_tautulli_libraries_table:
+        library_tasks['tautulli_{}'.format(library['section_id'])] = ('tautulli', get_cached_tautulli_library_media_info, (library,))
+        library_tasks['plex_{}'.format(library['section_id'])] = ('plex', get_cached_plex_media_info, (library,))
+    library_media_info = fetch_concurrently(library_tasks, FETCH_TIMEOUTS)
+    last_watched_index = load_last_watched_index()
+    overseerr_request_index = build_overseerr_request_index(upstream['overseerr_requests'] or [])
 
-logging.debug('parse_tautulli_libraries_table response: ' + str(parsed_tautulli_libraries_table))
-logging.info("✅ Parsed {} 'get_tautulli_libraries_table' result".format(len(parsed_tautulli_libraries_table)))
+    for library in parsed_tautulli_libraries_table:
+        tautulli_library_media_info = library_media_info['tautulli_{}'.format(library['section_id'])]
+        plex_library_media_info = library_media_info['plex_{}'.format(library['section_id'])]
+        if tautulli_library_media_info is None or plex_library_media_info is None:
+            logging.warning('🚧 Skipping {}, its Tautulli or Plex media info is unavailable'.format(library['section_name']))
+            continue
 
-for library in parsed_tautulli_libraries_table:
-    tautulli_library_media_info = get_tautulli_library_media_info(library)
-    plex_library_media_info = get_plex_media_info(library)
-    merged_media = merge_plex_tautulli_media_info(tautulli_library_media_info, plex_library_media_info, library)
+        merged_media = merge_plex_tautulli_media_info(tautulli_library_media_info, plex_library_media_info, library)
+        merged_media = apply_last_watched_index(merged_media, last_watched_index)
 
-    if library['section_type'] == 'movie':
-        merged_media = merge_merged_list_radarr_media_info(merged_media, radarr_movie_list)
-        merged_media = filter_merged_list_based_on_remove_limit(merged_media)
-        logging.info('📦 Merging {} merged list and Radarr media info'.format(library['section_name']))
+        if library['section_type'] == 'movie':
+            merged_media = merge_merged_list_radarr_media_info(merged_media, radarr_movie_list, library)
+            merged_media = apply_overseerr_request_index(merged_media, overseerr_request_index)
+            merged_media = filter_merged_list_based_on_remove_limit(merged_media, library)
+            logging.info('📦 Merging {} merged list and Radarr media info'.format(library['section_name']))
 
-    elif library['section_type'] == 'show':
-        merge_merged_list_sonarr_media_info(merged_media, sonarr_series_list)
+        elif library['section_type'] == 'show':
+            merged_media = merge_merged_list_sonarr_media_info(merged_media, sonarr_series_list, library)
+            merged_media = apply_overseerr_request_index(merged_media, overseerr_request_index)
+            merged_media = filter_merged_list_based_on_remove_limit(merged_media, library)
 
+    write_metrics(METRICS_REVISION)
+    save_recording(METRICS_REVISION)
 
 
-# Overseerr logic
-overseerr_media_list = get_overseerr_requests()
+if __name__ == '__main__':
+    start()
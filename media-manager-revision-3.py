@@ -1,61 +1,350 @@
+import argparse
+import collections
+import copy
+import datetime
+import heapq
+import hmac
+import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
+from urllib.parse import parse_qs, urlsplit
 
-import requests
 from dotenv import load_dotenv
-from plexapi.server import PlexServer
+
+from media_manager_common import (
+    REPLAY_PATH, MediaCandidate, apply_overseerr_request_index, build_overseerr_request_index, build_score_columns,
+    current_time, fetch_concurrently, fetch_pages_concurrently, get_session, instrumented, iter_json_array, load_recording,
+    parse_iso_date, project_overseerr_request, reset_metrics, run_metrics, save_recording, score_media_candidates,
+    write_metrics,
+)
 
 load_dotenv()
 
 # EDIT PARAMETERS IN .env FILE #
+# Several Plex servers or Radarr/Sonarr instances are separated by commas, with one token/API key each or a single
+# one shared by all of them, e.g. RADARR_URL=http://radarr:7878/,http://radarr-4k:7878/
 PLEX_URL = os.getenv('PLEX_URL')
 PLEX_TOKEN = os.getenv('PLEX_TOKEN')
 RADARR_URL = os.getenv('RADARR_URL')
 RADARR_APIKEY = os.getenv('RADARR_APIKEY')
 SONARR_URL = os.getenv('SONARR_URL')
 SONARR_APIKEY = os.getenv('SONARR_APIKEY')
+OVERSEERR_URL = os.getenv('OVERSEERR_URL')  # Optional, protects recent requests and clears removed media
+OVERSEERR_APIKEY = os.getenv('OVERSEERR_APIKEY')
 
 DRY_RUN = False
 PLEX_LIBRARY_NAMES = ['Series', 'Movies', 'Animation', 'TV Shows']
 PATH_TO_CHECK = '/data'
 SERVICE_TO_CHECK_FREE_DISKSPACE = 'sonarr'  # sonarr/radarr
 FREE_SPACE_THRESHOLD = 500  # Threshold in GB
+FREE_SPACE_THRESHOLDS = {PATH_TO_CHECK: FREE_SPACE_THRESHOLD}  # Threshold in GB per mount, e.g. {'/movies': 500, '/tv': 300}
+# A disk of a single host is keyed by host and path, e.g. {('nas-2', '/tv'): 300}, a path alone applies on every host
+FETCH_TIMEOUTS = {'plex': 300, 'radarr': 120, 'sonarr': 120, 'overseerr': 120}  # Seconds per service before its fetch is given up on
+DELETE_CONCURRENCY = 4  # Single deletes sent at once when the bulk editor endpoint is unavailable
+SEASON_CLEANUP = True  # Remove single seasons of a show instead of the whole series
+EPISODE_FILE_FETCH_CONCURRENCY = 8  # Sonarr episode file listings requested at once
+OVERSEERR_PAGE_SIZE = 500
+OVERSEERR_PROTECTION_DAYS = 90  # Days a requested title is kept however long ago it was watched
+RETENTION_WEIGHTS = {  # Score per unit of each factor, the highest scoring items are deleted first
+    'age': 1.0,  # Per day since last played, or added when never played
+    'size': 0.0,  # Per GB on disk
+    'play_count': 0.0,  # Per play, use a negative weight to keep popular titles longer
+    'rating': 0.0,  # Per rating point above 5 out of 10, use a negative weight to keep well rated titles longer
+    'requested': 0.0,  # Scaled by how recent the latest Overseerr request is, 1 right after the request
+}
+RETENTION_REQUEST_DECAY_DAYS = 90  # Days for the request factor to fall to about a third
+PLAN_MINIMIZE_OVERSHOOT = False  # Let a lower ranked item that frees less beyond the target finish a mount
+PLAN_OVERSHOOT_LOOKAHEAD = 50  # Further candidates, of any mount, read when picking the last item of a mount
+PLAN_RANK_BLOCK_SIZE = 256  # Best scoring candidates ordered at a time, doubled whenever more are taken
+PLEX_FAST_LOADER = True  # Read Plex listings with a streaming XML parser instead of building plexapi objects
+PLEX_PAGE_SIZE = 1000  # Items per Plex listing page read by the fast loader
+DAEMON_POLL_INTERVAL_MIN = 60  # Seconds between diskspace checks when a mount is at its threshold
+DAEMON_POLL_INTERVAL_MAX = 3600  # Seconds between diskspace checks when every mount has plenty of headroom
+DAEMON_FULL_HEADROOM = 1.0  # Free space above the threshold, as a fraction of it, that earns the longest interval
+DAEMON_LIBRARY_MAX_AGE = 6 * 3600  # Seconds the indexed library is reused between cleanups
+LAST_WATCHED_INDEX_PATH = os.getenv('LAST_WATCHED_INDEX_PATH', 'last-watched-index.json')
+LAST_WATCHED_RECONCILE_INTERVAL = 24 * 3600  # Seconds between history sweeps that catch missed webhook events
+LAST_WATCHED_SAVE_DELAY = 5  # Seconds webhook plays are collected before the index is written
+PLEX_PLAYBACK_EVENTS = ('media.play', 'media.resume', 'media.stop', 'media.scrobble')
+WEBHOOK_BIND_ADDRESS = os.getenv('WEBHOOK_BIND_ADDRESS', '127.0.0.1')  # Address the webhook listener accepts connections on
+WEBHOOK_BACKLOG = 128  # Connections waiting to be accepted by the webhook listener
+WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')  # Required by the webhook listener, sent as ?token= or an X-Webhook-Token header
+METRICS_REVISION = '3'
+
+
+
+def parse_instances(urls, keys):
+    """Pair comma separated URLs with their comma separated API keys"""
+    urls = [url.strip() for url in (urls or '').split(',') if url.strip()]
+    keys = [key.strip() for key in (keys or '').split(',')]
+    if len(keys) == 1:
+        keys = keys * len(urls)
+    if len(keys) != len(urls):
+        raise ValueError('Expected one API key for every one of {} URLs, got {}'.format(len(urls), len(keys)))
+    return list(zip(urls, keys))
+
+
+PLEX_SERVERS = parse_instances(PLEX_URL, PLEX_TOKEN)
+RADARR_INSTANCES = parse_instances(RADARR_URL, RADARR_APIKEY)
+SONARR_INSTANCES = parse_instances(SONARR_URL, SONARR_APIKEY)
 
 logging.root.setLevel(logging.NOTSET)
 logging.basicConfig(level=logging.INFO)
 
 DIFFERENCE_IN_FREESPACE_AND_THRESHOLD = 0
 
+plex_servers = {}
+library_candidates = None
+library_candidates_built_at = 0
+library_score_columns = None  # build_score_columns of library_candidates, kept in step with them
+
+webhook_server = None
+last_watched_index = None
+last_watched_lock = threading.Lock()
+last_watched_save_lock = threading.Lock()
+last_watched_save_timer = None
+
+
+class PlexItem:
+    """The attributes the cleanup reads from one item of a Plex listing, named like their plexapi counterparts"""
+    __slots__ = ('ratingKey', 'type', 'title', 'addedAt', 'lastViewedAt', 'viewedAt',
+                 'grandparentRatingKey', 'parentIndex', 'guids', 'viewCount', 'audienceRating', 'rating')
+
+    def __init__(self, element):
+        self.ratingKey = get_int_attribute(element, 'ratingKey')
+        self.type = element.get('type')
+        self.title = element.get('title')
+        self.addedAt = get_int_attribute(element, 'addedAt')  # Epoch seconds
+        self.lastViewedAt = get_int_attribute(element, 'lastViewedAt')  # Epoch seconds
+        self.viewedAt = get_int_attribute(element, 'viewedAt')  # Epoch seconds, history entries only
+        self.grandparentRatingKey = get_int_attribute(element, 'grandparentRatingKey')
+        self.parentIndex = get_int_attribute(element, 'parentIndex')
+        self.guids = [guid.get('id') for guid in element.iter('Guid')]
+        self.viewCount = get_int_attribute(element, 'viewCount')
+        self.audienceRating = get_float_attribute(element, 'audienceRating')  # Out of 10
+        self.rating = get_float_attribute(element, 'rating')  # Out of 10
+
+    def __repr__(self):
+        return 'PlexItem({!r}, {!r}, {!r})'.format(self.ratingKey, self.type, self.title)
+
 
 def setup_server(url, token):
-    return PlexServer(url, token)
+    if url not in plex_servers:
+        # Imported here so runs that stop at the diskspace check never load plexapi
+        from plexapi.server import PlexServer
+        plex_servers[url] = PlexServer(url, token, session=get_session('plex'))
+    return plex_servers[url]
+
+
+def get_int_attribute(element, name):
+    value = element.get(name)
+    return int(value) if value else None
+
+
+def get_float_attribute(element, name):
+    value = element.get(name)
+    return float(value) if value else None
+
+
+def iter_plex_listing(plex, path, params):
+    """Yield a PlexItem for every item of a paged Plex XML listing while the response is parsed"""
+    from xml.etree import ElementTree
+
+    start = 0
+    while True:
+        page_params = dict(params, **{'X-Plex-Container-Start': start, 'X-Plex-Container-Size': PLEX_PAGE_SIZE})
+        page_size = 0
+        total_size = 0
+
+        with get_session('plex').get(plex.url(path, includeToken=True), params=page_params, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            container = None
+            depth = 0
+            for event, element in ElementTree.iterparse(r.raw, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if container is None:
+                        container = element
+                        total_size = int(container.get('totalSize') or 0)
+                    continue
+
+                depth -= 1
+                if depth == 1:  # An item directly below the MediaContainer
+                    yield PlexItem(element)
+                    page_size += 1
+                    # Drop every parsed item so a page never builds up a tree
+                    container.clear()
+
+        start += page_size
+        if page_size < PLEX_PAGE_SIZE or start >= total_size:
+            return
+
+
+@instrumented
+def get_plex_libraries_metadata(plex, library_name):
+    if PLEX_FAST_LOADER:
+        section = plex.library.section(library_name)
+        return list(iter_plex_listing(plex, '/library/sections/{}/all'.format(section.key), {'includeGuids': 1}))
 
+    library_metadata = plex.library.section(library_name).all()
+    # Reading an unset attribute, like lastViewedAt of an unplayed item, would otherwise reload the whole item
+    for item in library_metadata:
+        item._autoReload = False
+    return library_metadata
 
-def get_plex_libraries_metadata(plex, library_name):
-    return plex.library.section(library_name).all()
 
+def get_epoch(value):
+    # plexapi items carry datetimes, fast loader items epoch seconds already
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    return value
 
-def get_full_plex_history(plex, rating_key):
-    return plex.history(maxresults=1, ratingKey=rating_key)
 
+def update_last_viewed_index(last_viewed_index, rating_key, viewed_at):
+    if rating_key is None or viewed_at is None:
+        return
+    viewed_at = get_epoch(viewed_at)
+    if rating_key not in last_viewed_index or last_viewed_index[rating_key] < viewed_at:
+        last_viewed_index[rating_key] = viewed_at
 
-def sort_library_metadata(library_metadata):
-    if library_metadata.lastViewedAt:
-        return library_metadata.lastViewedAt
-    else:
-        return library_metadata.addedAt
 
+def get_season_key(show_rating_key, season_number):
+    """Key of a season in the last viewed index, the history only names a season by its show and number"""
+    if not show_rating_key or season_number is None:
+        return None
+    return int(show_rating_key), int(season_number)
+
+
+@instrumented
+def get_plex_history(plex, mindate=None):
+    if PLEX_FAST_LOADER:
+        params = {'sort': 'viewedAt:desc'}
+        if mindate:
+            params['viewedAt>'] = int(mindate.timestamp())
+        return list(iter_plex_listing(plex, '/status/sessions/history/all', params))
+
+    return plex.history(mindate=mindate)
+
+
+@instrumented
+def get_plex_last_viewed_index(library_metadata, history):
+    logging.info('📦 Building Plex last viewed index')
+    last_viewed_index = {}
+
+    # The section listing already carries lastViewedAt for the server owner
+    for item in library_metadata:
+        update_last_viewed_index(last_viewed_index, item.ratingKey, item.lastViewedAt)
+
+    # A single paginated sweep of the history endpoint covers every other account, episodes are
+    # indexed under their show (grandparent) so show libraries can be looked up by their own ratingKey,
+    # and under their show and season number for season level cleanup
+    for entry in history:
+        show_rating_key = getattr(entry, 'grandparentRatingKey', None)
+        update_last_viewed_index(last_viewed_index, entry.ratingKey, entry.viewedAt)
+        update_last_viewed_index(last_viewed_index, show_rating_key, entry.viewedAt)
+        update_last_viewed_index(last_viewed_index, get_season_key(show_rating_key, getattr(entry, 'parentIndex', None)),
+                                 entry.viewedAt)
+
+    logging.info('✅ Indexed last viewed date for {} Plex items'.format(len(last_viewed_index)))
+    return last_viewed_index
+
+
+def get_season_last_viewed_index(last_viewed_index):
+    """Group the season keys of a last viewed index by show rating key"""
+    season_last_viewed_index = {}
+    for key, viewed_at in last_viewed_index.items():
+        if isinstance(key, tuple):
+            season_last_viewed_index.setdefault(key[0], {})[key[1]] = viewed_at
+    return season_last_viewed_index
+
+
+def build_media_candidate(library_item, last_viewed_index, season_last_viewed_index):
+    external_ids = get_external_ids(library_item)
+    last_viewed_at = last_viewed_index.get(library_item.ratingKey)
+
+    return MediaCandidate(
+        rating_key=library_item.ratingKey,
+        type=library_item.type,
+        title=library_item.title,
+        imdb_id=external_ids.get('imdbId'),
+        tmdb_id=external_ids.get('tmdbId'),
+        tvdb_id=external_ids.get('tvdbId'),
+        added_at=get_epoch(library_item.addedAt),
+        last_viewed_at=last_viewed_at,
+        season_last_viewed=season_last_viewed_index.get(library_item.ratingKey, {}) if library_item.type == 'show' else None,
+        play_count=getattr(library_item, 'viewCount', None) or 0,
+        rating=get_plex_rating(library_item),
+    )
+
+
+def get_plex_rating(library_item):
+    rating = getattr(library_item, 'audienceRating', None)
+    if rating is None:
+        rating = getattr(library_item, 'rating', None)
+    return float(rating) if rating is not None else None
+
+
+def merge_media_candidates(candidate, other):
+    """Fold a Plex item of another server that matched the same Radarr/Sonarr item into candidate"""
+    # The latest date of either server wins, a title played or added on any server is kept as long as there
+    candidate.added_at = max(candidate.added_at, other.added_at)
+    if other.last_viewed_at and other.last_viewed_at > (candidate.last_viewed_at or 0):
+        candidate.last_viewed_at = other.last_viewed_at
+    if other.season_last_viewed:
+        season_last_viewed = dict(candidate.season_last_viewed or {})
+        for season, viewed_at in other.season_last_viewed.items():
+            season_last_viewed[season] = max(season_last_viewed.get(season, 0), viewed_at)
+        candidate.season_last_viewed = season_last_viewed
+    candidate.play_count += other.play_count
+    if candidate.rating is None:
+        candidate.rating = other.rating
+
+
+def sort_library_metadata(candidate):
+    return candidate.last_activity_at()
+
+
+def iter_ranked_candidates(candidates, scores, eligible):
+    """Yield the eligible candidates from the highest retention score down, ordering only as many as are taken"""
+    import numpy as np
+
+    remaining = eligible.nonzero()[0]
+    block_size = PLAN_RANK_BLOCK_SIZE
+    while remaining.size:
+        remaining_scores = scores[remaining]
+        if remaining.size > block_size:
+            # Every candidate scoring as high as the block_size-th best, ties are never split between blocks
+            threshold = np.partition(remaining_scores, remaining.size - block_size)[remaining.size - block_size]
+            in_block = remaining_scores >= threshold
+        else:
+            in_block = np.ones(remaining.size, dtype=bool)
+
+        # Equal scores go oldest first, the position keeps the order of fully equal candidates
+        heap = [(-score, sort_library_metadata(candidates[index]), index)
+                for score, index in zip(remaining_scores[in_block].tolist(), remaining[in_block].tolist())]
+        heapq.heapify(heap)
+        while heap:
+            yield candidates[heapq.heappop(heap)[2]]
+
+        remaining = remaining[~in_block]
+        block_size *= 2
 
-def check_radarr_free_diskspace(path):
+
+def get_radarr_diskspace(instance):
     logging.info('📦 Retrieving disk(s) information from Radarr')
+    url, apikey = RADARR_INSTANCES[instance]
 
     payload = {
-        'apikey': RADARR_APIKEY,
+        'apikey': apikey,
     }
 
     try:
-        r = requests.get(RADARR_URL.rstrip('/') + '/api/v3/diskspace', params=payload)
+        r = get_session('radarr').get(url.rstrip('/') + '/api/v3/diskspace', params=payload)
         response = r.json()
         logging.debug('get_radarr_diskspace response: ' + str(response))
 
@@ -63,21 +352,21 @@ def check_radarr_free_diskspace(path):
             logging.warning('🚧 No Radarr disk(s) found')
         else:
             logging.info('✅ Retrieved {} Radarr disk(s)'.format(len(response)))
-
-        return get_freespace_on_specified_path(response, path)
+        return response
     except Exception as e:
         logging.error('❌ Radarr API \'diskspace\' request failed: {0}'.format(e))
 
 
-def check_sonarr_free_diskspace(path):
+def get_sonarr_diskspace(instance):
     logging.info('📦 Retrieving disk(s) information from Sonarr')
+    url, apikey = SONARR_INSTANCES[instance]
 
     payload = {
-        'apikey': SONARR_APIKEY,
+        'apikey': apikey,
     }
 
     try:
-        r = requests.get(SONARR_URL.rstrip('/') + '/api/v3/diskspace', params=payload)
+        r = get_session('sonarr').get(url.rstrip('/') + '/api/v3/diskspace', params=payload)
         response = r.json()
         logging.debug('get_sonarr_diskspace response: ' + str(response))
 
@@ -85,11 +374,57 @@ def check_sonarr_free_diskspace(path):
             logging.warning('🚧 No Sonarr disk(s) found')
         else:
             logging.info('✅ Retrieved {} Sonarr disk(s)'.format(len(response)))
-        return get_freespace_on_specified_path(response, path)
+        return response
     except Exception as e:
         logging.error('❌ Sonarr API \'diskspace\' request failed: {0}'.format(e))
 
 
+@instrumented
+def get_diskspace(service):
+    if service == 'sonarr':
+        instances, get_instance_diskspace = SONARR_INSTANCES, get_sonarr_diskspace
+    elif service == 'radarr':
+        instances, get_instance_diskspace = RADARR_INSTANCES, get_radarr_diskspace
+    else:
+        return None
+
+    responses = [get_instance_diskspace(instance) for instance in range(len(instances))]
+    if all(response is None for response in responses):
+        return None
+
+    # Instances on one host, or containers sharing one disk, report the same mount. Their reports are merged into
+    # one disk listing every reporting host, so the same free space is never cleaned up twice
+    diskspace = []
+    for (url, _), response in zip(instances, responses):
+        host = get_instance_host(url)
+        for disk in response or []:
+            same_disk = next((known for known in diskspace if is_same_disk(known, host, disk)), None)
+            if same_disk is None:
+                diskspace.append(dict(disk, hosts=(host,)))
+            elif host not in same_disk['hosts']:
+                same_disk['hosts'] += (host,)
+    return diskspace
+
+
+def is_same_disk(known, host, disk):
+    if known['path'] != disk['path']:
+        return False
+    if host in known['hosts']:
+        return True
+    # Downloads keep writing between the requests, so free space only has to agree to within a GB
+    return (known.get('totalSpace') == disk.get('totalSpace') and
+            abs(known['freeSpace'] - disk['freeSpace']) < 1073741824)
+
+
+def get_instance_host(url):
+    return urlsplit(url).hostname
+
+
+def format_mount(mount):
+    """Mounts are (hosts, path), hosts being every host reporting the disk"""
+    return '{}:{}'.format(','.join(mount[0]), mount[1])
+
+
 def sizeof_fmt(num, suffix="B"):
     for unit in ("", "K", "M", "G", "T", "P", "E", "Z"):
         if abs(num) < 1024.0:
@@ -98,16 +433,22 @@ def sizeof_fmt(num, suffix="B"):
     return f"{num:.1f}Yi{suffix}"
 
 
-def get_freespace_on_specified_path(data, path):
-    for object in data:
-        if object['path'] == path:
-            return object['freeSpace']
+def get_mount_thresholds(diskspace, freespace_thresholds):
+    """Return (mount, free bytes, threshold in GB) of every reported mount with a threshold, mounts are (hosts, path)"""
+    mount_thresholds = []
+    for disk in diskspace:
+        freespace_threshold = next((freespace_thresholds[(host, disk['path'])] for host in disk['hosts']
+                                    if (host, disk['path']) in freespace_thresholds), freespace_thresholds.get(disk['path']))
+        if freespace_threshold is not None:
+            mount_thresholds.append(((disk['hosts'], disk['path']), disk['freeSpace'], freespace_threshold))
+    return mount_thresholds
 
 
 def get_external_ids(library_item):
     guids_dict = {}
     for guid in library_item.guids:
-        parts = guid.id.split('://')
+        # plexapi items carry Guid objects, fast loader items the id strings
+        parts = getattr(guid, 'id', guid).split('://')
         if len(parts) == 2:
             key = parts[0]
             value = parts[1]
@@ -121,37 +462,148 @@ def get_external_ids(library_item):
     return modified_guids_dict
 
 
-def check_diskspace(path, service, freespace_threshold):
-    if SERVICE_TO_CHECK_FREE_DISKSPACE == 'sonarr':
-        free_diskspace = check_sonarr_free_diskspace(path)
-    elif SERVICE_TO_CHECK_FREE_DISKSPACE == 'radarr':
-        free_diskspace = check_radarr_free_diskspace(path)
+def check_diskspace(diskspace, service, freespace_thresholds):
+    """Return the bytes to free for every (hosts, path) mount that is below its threshold"""
+    bytes_to_delete = {}
+    mount_thresholds = get_mount_thresholds(diskspace or [], freespace_thresholds)
+
+    reported = {path for (_, path), _, _ in mount_thresholds}
+    reported.update((host, path) for (hosts, path), _, _ in mount_thresholds for host in hosts)
+    for key in freespace_thresholds:
+        if key not in reported:
+            logging.warning('🚧 The directory {} is not reported by {}'.format(
+                '{}:{}'.format(*key) if isinstance(key, tuple) else key, service))
+
+    for mount, free_diskspace, freespace_threshold in mount_thresholds:
+        if free_diskspace < freespace_threshold * 1073741824:
+            space_to_clear = freespace_threshold * 1073741824 - free_diskspace  # Bytes
+            logging.info('💾 The directory {} in {} has {} free space, '
+                         'this is below the set threshold of {} GB. Running cleanup to free {}'
+                         .format(format_mount(mount), service, sizeof_fmt(free_diskspace), freespace_threshold,
+                                 sizeof_fmt(space_to_clear)))
+            bytes_to_delete[mount] = space_to_clear
+            continue
+        logging.info(
+            '💾 The directory {} in {} has {} free space, '
+            'this is above the set threshold of {} GB. Skipping cleanup'
+            .format(format_mount(mount), service, sizeof_fmt(free_diskspace), freespace_threshold))
+
+    return bytes_to_delete
+
+
+def get_candidate_mount(candidate, mounts):
+    """Return the deepest (hosts, path) mount containing the Radarr/Sonarr path of candidate
+
+    Mounts reported by the host running the candidate's Radarr/Sonarr instance are preferred. When that host isn't
+    among them, e.g. a Radarr container sharing the disks Sonarr reports, the path has to be on a single disk,
+    otherwise the mount is ambiguous and None is returned.
+    """
+    if not candidate.path:
+        return None
 
-    if free_diskspace < freespace_threshold * 1073741824:
-        global space_to_clear
-        logging.info('💾 The directory {} in {} has {} free space, '
-                     'this is below the set threshold of {} GB. Running cleanup'
-                     .format(path, service, sizeof_fmt(free_diskspace), freespace_threshold))
-        space_to_clear = free_diskspace - freespace_threshold
-        return True
-    logging.info(
-        '💾 The directory {} in {} has {} free space, '
-        'this is above the set threshold of {} GB. Skipping cleanup'
-        .format(path, service, sizeof_fmt(free_diskspace), freespace_threshold))
-    return False
+    matching_mounts = [(hosts, path) for hosts, path in mounts
+                       if candidate.path == path or candidate.path.startswith(path.rstrip('/') + '/')]
+    if candidate.arr_instance is not None:
+        instances = RADARR_INSTANCES if candidate.type == 'movie' else SONARR_INSTANCES
+        instance_host = get_instance_host(instances[candidate.arr_instance][0])
+        instance_mounts = [mount for mount in matching_mounts if instance_host in mount[0]]
+        if instance_mounts:
+            matching_mounts = instance_mounts
+    if len({hosts for hosts, _ in matching_mounts}) > 1:
+        return None
+    return max(matching_mounts, key=lambda mount: len(mount[1]), default=None)
+
+
+def log_planned_candidate(candidate):
+    if candidate.type == 'movie':
+        logging.info("Movie: {}".format(candidate.title))
+    elif candidate.type == 'season':
+        logging.info("Season: {} season {}".format(candidate.title, candidate.season))
+    else:  # Assuming 'show' type
+        logging.info("Show: {} ".format(candidate.title))
+
+
+@instrumented
+def plan_cleanup(ranked_candidates, bytes_to_delete):
+    """Take candidates in retention order until the bytes to delete of every mount are covered
+
+    Every mount only competes with the items stored on it, ranked_candidates is only read as far as needed.
+    """
+    for mount, mount_bytes in bytes_to_delete.items():
+        logging.info('📦 Planning cleanup of {} on {}'.format(sizeof_fmt(mount_bytes), format_mount(mount)))
+    ranked_candidates = iter(ranked_candidates)
+    deferred = collections.deque()  # Pulled while looking ahead on one mount, still to be planned for another
+    remaining_bytes = dict(bytes_to_delete)
+    selected_bytes = {mount: 0 for mount in bytes_to_delete}
+    selected_candidates = []
+
+    def next_candidate():
+        return deferred.popleft() if deferred else next(ranked_candidates, None)
+
+    while any(mount_bytes > 0 for mount_bytes in remaining_bytes.values()):
+        candidate = next_candidate()
+        if candidate is None:
+            break
+        mount = get_candidate_mount(candidate, remaining_bytes)
+        if mount is None:
+            logging.warning('🚧 Skipping {}, {} is not on exactly one checked mount'.format(candidate.title, candidate.path))
+            continue
+        if remaining_bytes[mount] <= 0:
+            continue
+
+        if PLAN_MINIMIZE_OVERSHOOT and candidate.size >= remaining_bytes[mount]:
+            # candidate finishes the mount, a smaller one further down that still covers it frees less beyond the target
+            # Candidates of other mounts count against the lookahead too, so a full mount never reads the whole ranking
+            other_mounts = []
+            for _ in range(PLAN_OVERSHOOT_LOOKAHEAD):
+                other = next_candidate()
+                if other is None:
+                    break
+                if get_candidate_mount(other, remaining_bytes) != mount:
+                    other_mounts.append(other)
+                elif remaining_bytes[mount] <= other.size < candidate.size:
+                    candidate = other
+            deferred.extendleft(reversed(other_mounts))
+
+        log_planned_candidate(candidate)
+        selected_candidates.append(candidate)
+        selected_bytes[mount] += candidate.size
+        remaining_bytes[mount] -= candidate.size
+
+    for mount, mount_bytes in remaining_bytes.items():
+        if mount_bytes > 0:
+            logging.warning('🚧 Only {} of removable media found on {}'.format(sizeof_fmt(selected_bytes[mount]),
+                                                                              format_mount(mount)))
+    return selected_candidates
+
+
+def project_radarr_movie(movie, instance):
+    return {
+        'id': movie['id'],
+        'instance': instance,
+        'title': movie['title'],
+        'imdbId': movie.get('imdbId'),
+        'tmdbId': movie.get('tmdbId'),
+        'path': movie.get('path'),
+        'sizeOnDisk': movie.get('sizeOnDisk', 0),
+    }
 
 
-def get_radarr_movies():
+@instrumented
+def get_radarr_movies(instance):
     logging.info('📦 Retrieving Radarr movies')
+    url, apikey = RADARR_INSTANCES[instance]
 
     payload = {
-        'apikey': RADARR_APIKEY,
+        'apikey': apikey,
     }
 
     try:
-        r = requests.get(RADARR_URL.rstrip('/') + '/api/v3/movie', params=payload)
-        response = r.json()
-        logging.debug('get_radarr_movies response: ' + str(response))
+        with get_session('radarr').get(url.rstrip('/') + '/api/v3/movie', params=payload, stream=True) as r:
+            r.raise_for_status()
+            # Only the fields the cleanup uses are kept while the array is decoded
+            response = [project_radarr_movie(item, instance) for item in iter_json_array(r)]
+        logging.debug('get_radarr_movies response: %s', response)
 
         if len(response) == 0:
             logging.warning('🚧 No Radarr movies found')
@@ -163,40 +615,64 @@ def get_radarr_movies():
         logging.error('❌ Radarr API \'movie\' request failed: {0}'.format(e))
 
 
+@instrumented
 def delete_radarr_movie(movie):
-    logging.info('📦 Deleting Radarr movie {}'.format(movie['title']))
+    logging.info('📦 Deleting Radarr movie {}'.format(movie.title))
+    url, apikey = RADARR_INSTANCES[movie.arr_instance]
 
     payload = {
-        'apikey': RADARR_APIKEY,
+        'apikey': apikey,
         'deleteFiles': True
     }
 
     try:
-        r = requests.delete(RADARR_URL.rstrip('/') + '/api/v3/movie/{}'.format(movie['id']), params=payload)
-        response = r.json()
-        logging.debug('delete_radarr_movie response: ' + str(response))
+        r = get_session('radarr').delete(url.rstrip('/') + '/api/v3/movie/{}'.format(movie.arr_id), params=payload)
+        logging.debug('delete_radarr_movie response: ' + r.text)
 
         if r.status_code != 200:
             logging.warning('🚧 No Radarr show found')
         else:
-            logging.info('✅ Deleted {} Radarr movie'.format(movie['title']))
+            logging.info('✅ Deleted {} Radarr movie'.format(movie.title))
 
-        return response
+        return r.status_code == 200
     except Exception as e:
         logging.error('❌ Radarr API \'movie\' request failed: {0}'.format(e))
+        return False
+
+
+def project_sonarr_show(show, instance):
+    return {
+        'id': show['id'],
+        'instance': instance,
+        'title': show['title'],
+        'imdbId': show.get('imdbId'),
+        'tmdbId': show.get('tmdbId'),
+        'tvdbId': show.get('tvdbId'),
+        'path': show.get('path'),
+        'statistics': {'sizeOnDisk': show.get('statistics', {}).get('sizeOnDisk', 0)},
+        # Season candidates are built from these statistics, without a request per show
+        'seasons': [{'seasonNumber': season['seasonNumber'],
+                     'sizeOnDisk': season['statistics']['sizeOnDisk'],
+                     'previousAiring': season['statistics'].get('previousAiring')}
+                    for season in show.get('seasons', []) if season.get('statistics', {}).get('sizeOnDisk')],
+    }
 
 
-def get_sonarr_shows():
+@instrumented
+def get_sonarr_shows(instance):
     logging.info('📦 Retrieving Sonarr shows')
+    url, apikey = SONARR_INSTANCES[instance]
 
     payload = {
-        'apikey': SONARR_APIKEY,
+        'apikey': apikey,
     }
 
     try:
-        r = requests.get(SONARR_URL.rstrip('/') + '/api/v3/series', params=payload)
-        response = r.json()
-        logging.debug('get_sonarr_series response: ' + str(response))
+        with get_session('sonarr').get(url.rstrip('/') + '/api/v3/series', params=payload, stream=True) as r:
+            r.raise_for_status()
+            # Only the fields the cleanup uses are kept while the array is decoded
+            response = [project_sonarr_show(item, instance) for item in iter_json_array(r)]
+        logging.debug('get_sonarr_series response: %s', response)
 
         if len(response) == 0:
             logging.warning('🚧 No Sonarr series found')
@@ -208,105 +684,508 @@ def get_sonarr_shows():
         logging.error('❌ Sonarr API \'series\' request failed: {0}'.format(e))
 
 
+@instrumented
 def delete_sonarr_show(show):
-    logging.info('📦 Deleting Sonarr show {}'.format(show['title']))
+    logging.info('📦 Deleting Sonarr show {}'.format(show.title))
+    url, apikey = SONARR_INSTANCES[show.arr_instance]
 
     payload = {
-        'apikey': SONARR_APIKEY,
+        'apikey': apikey,
         'deleteFiles': True
     }
 
     try:
-        r = requests.delete(SONARR_URL.rstrip('/') + '/api/v3/series/{}'.format(show['id']), params=payload)
-        response = r.json()
-        logging.debug('delete_sonarr_show response: ' + str(response))
+        r = get_session('sonarr').delete(url.rstrip('/') + '/api/v3/series/{}'.format(show.arr_id), params=payload)
+        logging.debug('delete_sonarr_show response: ' + r.text)
 
         if r.status_code != 200:
             logging.warning('🚧 No Sonarr show found')
         else:
-            logging.info('✅ Deleted {} Sonarr show'.format(show['title']))
+            logging.info('✅ Deleted {} Sonarr show'.format(show.title))
 
-        return response
+        return r.status_code == 200
     except Exception as e:
         logging.error('❌ Sonarr API \'series\' request failed: {0}'.format(e))
+        return False
 
 
-def get_id_type(item):
-    if 'imdbId' in item:
-        return 'imdbId'
-    elif 'tmdbId' in item:
-        return 'tmdbId'
-    elif 'tvdbId' in item:
-        return 'tvdbId'
-    else:
-        return None
+def project_sonarr_episode_file(episode_file):
+    return {
+        'id': episode_file['id'],
+        'seasonNumber': episode_file['seasonNumber'],
+    }
 
 
-def find_matching_item(library_item, library_type, library):
-    external_ids = get_external_ids(library_item)
-    id_type = None
+@instrumented
+def get_sonarr_episode_files(show):
+    logging.debug('Retrieving Sonarr episode files of {}'.format(show.title))
+    url, apikey = SONARR_INSTANCES[show.arr_instance]
+
+    payload = {
+        'apikey': apikey,
+        'seriesId': show.arr_id,
+    }
+
+    try:
+        with get_session('sonarr').get(url.rstrip('/') + '/api/v3/episodefile', params=payload, stream=True) as r:
+            r.raise_for_status()
+            response = [project_sonarr_episode_file(item) for item in iter_json_array(r)]
+        logging.debug('get_sonarr_episode_files response: %s', response)
+        return response
+    except Exception as e:
+        logging.error('❌ Sonarr API \'episodefile\' request for {} failed: {}'.format(show.title, e))
+
+
+def build_season_candidates(show, seasons):
+    """Return one candidate per season of show that has files on disk, seasons are from the Sonarr series listing"""
+    season_candidates = []
+    for season in sorted(seasons, key=lambda season: season['seasonNumber']):
+        season_number = season['seasonNumber']
+        previous_airing = parse_iso_date(season['previousAiring']) if season['previousAiring'] else 0
+        season_candidates.append(MediaCandidate(
+            rating_key=show.rating_key,
+            type='season',
+            title=show.title,
+            imdb_id=show.imdb_id,
+            tmdb_id=show.tmdb_id,
+            tvdb_id=show.tvdb_id,
+            # A season counts as added when its latest episode aired, or when the show was added if that is later
+            added_at=max(show.added_at, previous_airing),
+            last_viewed_at=(show.season_last_viewed or {}).get(season_number),
+            size=season['sizeOnDisk'],
+            arr_id=show.arr_id,
+            path=show.path,
+            season=season_number,
+            arr_instance=show.arr_instance,
+            plex_server=show.plex_server,
+            # Plex only counts plays of the whole show, a season keeps the rating but not the play count
+            rating=show.rating,
+        ))
+    return season_candidates
+
+
+@instrumented
+def split_show_candidates(candidates, show_seasons):
+    """Replace every show by its seasons, show_seasons maps (instance, series id) to the seasons Sonarr lists"""
+    shows = [candidate for candidate in candidates if candidate.type == 'show']
+    logging.info('📦 Splitting {} shows into seasons'.format(len(shows)))
+
+    split_candidates = [candidate for candidate in candidates if candidate.type != 'show']
+    for show in shows:
+        seasons = show_seasons.get((show.arr_instance, show.arr_id))
+        if not seasons:
+            split_candidates.append(show)  # Keep the whole series as a candidate when its seasons are unknown
+        else:
+            split_candidates.extend(build_season_candidates(show, seasons))
+
+    logging.info('✅ Split {} shows into {} season candidates'.format(
+        len(shows), sum(1 for candidate in split_candidates if candidate.type == 'season')))
+    return split_candidates
+
+
+@instrumented
+def resolve_season_episode_files(seasons):
+    """Look up the episode files of the seasons picked for removal, returns the seasons whose files are known
+
+    Only the shows of these seasons are listed, every season of a show shares its listing.
+    """
+    shows = {}
+    for season in seasons:
+        shows.setdefault((season.arr_instance, season.arr_id), []).append(season)
+    show_seasons = list(shows.values())
+    logging.info('📦 Retrieving Sonarr episode files of {} shows'.format(len(show_seasons)))
+
+    with ThreadPoolExecutor(max_workers=EPISODE_FILE_FETCH_CONCURRENCY) as executor:
+        episode_files = list(executor.map(get_sonarr_episode_files, [show[0] for show in show_seasons]))
+
+    resolved = []
+    for show, show_episode_files in zip(show_seasons, episode_files):
+        if show_episode_files is None:
+            logging.error('❌ Skipping {} seasons of {}, their episode files are unknown'.format(len(show), show[0].title))
+            continue
+        for season in show:
+            season.episode_file_ids = [f['id'] for f in show_episode_files if f['seasonNumber'] == season.season]
+            resolved.append(season)
+    return resolved
+
+
+@instrumented
+def unmonitor_sonarr_seasons(seasons):
+    """Stop Sonarr from searching for the episodes of removed seasons again"""
+    url, apikey = SONARR_INSTANCES[seasons[0].arr_instance]
+
+    payload = {
+        'apikey': apikey,
+    }
+
+    series = {}
+    for season in seasons:
+        series.setdefault(season.arr_id, []).append({'seasonNumber': season.season, 'monitored': False})
+    body = {
+        'series': [{'id': series_id, 'seasons': series_seasons} for series_id, series_seasons in series.items()]
+    }
+
+    try:
+        r = get_session('sonarr').post(url.rstrip('/') + '/api/v3/seasonpass', params=payload, json=body)
+        logging.debug('unmonitor_sonarr_seasons response: ' + r.text)
+        r.raise_for_status()
+    except Exception as e:
+        logging.warning('🚧 Could not unmonitor {} removed seasons in Sonarr: {}'.format(len(seasons), e))
+
+
+@instrumented
+def delete_sonarr_season(season):
+    logging.info('📦 Deleting Sonarr season {} of {}'.format(season.season, season.title))
+    url, apikey = SONARR_INSTANCES[season.arr_instance]
+
+    payload = {
+        'apikey': apikey,
+    }
+
+    try:
+        deleted = True
+        for episode_file_id in season.episode_file_ids:
+            r = get_session('sonarr').delete(url.rstrip('/') + '/api/v3/episodefile/{}'.format(episode_file_id),
+                                             params=payload)
+            logging.debug('delete_sonarr_season response: ' + r.text)
+            deleted = deleted and r.status_code == 200
+
+        if not deleted:
+            logging.warning('🚧 Not every episode file of {} season {} was found'.format(season.title, season.season))
+        else:
+            logging.info('✅ Deleted {} season {}'.format(season.title, season.season))
+            unmonitor_sonarr_seasons([season])
+
+        return deleted
+    except Exception as e:
+        logging.error('❌ Sonarr API \'episodefile\' request failed: {0}'.format(e))
+        return False
+
+
+@instrumented
+def bulk_delete_radarr_movies(movies):
+    logging.info('📦 Deleting {} Radarr movies through the movie editor'.format(len(movies)))
+    url, apikey = RADARR_INSTANCES[movies[0].arr_instance]
+
+    payload = {
+        'apikey': apikey,
+    }
+
+    body = {
+        'movieIds': [movie.arr_id for movie in movies],
+        'deleteFiles': True,
+        'addImportExclusion': False
+    }
+
+    r = get_session('radarr').delete(url.rstrip('/') + '/api/v3/movie/editor', params=payload, json=body)
+    logging.debug('bulk_delete_radarr_movies response: ' + r.text)
+    r.raise_for_status()
+    logging.info('✅ Deleted {} Radarr movies'.format(len(movies)))
+
+
+@instrumented
+def bulk_delete_sonarr_shows(shows):
+    logging.info('📦 Deleting {} Sonarr shows through the series editor'.format(len(shows)))
+    url, apikey = SONARR_INSTANCES[shows[0].arr_instance]
+
+    payload = {
+        'apikey': apikey,
+    }
+
+    body = {
+        'seriesIds': [show.arr_id for show in shows],
+        'deleteFiles': True
+    }
+
+    r = get_session('sonarr').delete(url.rstrip('/') + '/api/v3/series/editor', params=payload, json=body)
+    logging.debug('bulk_delete_sonarr_shows response: ' + r.text)
+    r.raise_for_status()
+    logging.info('✅ Deleted {} Sonarr shows'.format(len(shows)))
+
+
+@instrumented
+def bulk_delete_sonarr_seasons(seasons):
+    logging.info('📦 Deleting {} Sonarr seasons through the episode file bulk endpoint'.format(len(seasons)))
+    url, apikey = SONARR_INSTANCES[seasons[0].arr_instance]
+
+    payload = {
+        'apikey': apikey,
+    }
+
+    body = {
+        'episodeFileIds': [episode_file_id for season in seasons for episode_file_id in season.episode_file_ids]
+    }
+
+    r = get_session('sonarr').delete(url.rstrip('/') + '/api/v3/episodefile/bulk', params=payload, json=body)
+    logging.debug('bulk_delete_sonarr_seasons response: ' + r.text)
+    r.raise_for_status()
+    logging.info('✅ Deleted {} Sonarr episode files'.format(len(body['episodeFileIds'])))
+    unmonitor_sonarr_seasons(seasons)
+
+
+@instrumented
+def delete_candidates(candidates):
+    """Delete the candidates in one editor call per service, returns the candidates that were removed"""
+    deleted = []
+    services = (
+        ('Radarr', [c for c in candidates if c.type == 'movie'], bulk_delete_radarr_movies, delete_radarr_movie),
+        ('Sonarr', [c for c in candidates if c.type == 'show'], bulk_delete_sonarr_shows, delete_sonarr_show),
+        ('Sonarr', [c for c in candidates if c.type == 'season'], bulk_delete_sonarr_seasons, delete_sonarr_season),
+    )
+
+    for service, items, bulk_delete, delete in services:
+        if items and items[0].type == 'season':
+            items = resolve_season_episode_files(items)
+
+        # Every Radarr/Sonarr instance gets its own editor call
+        instances = {}
+        for item in items:
+            instances.setdefault(item.arr_instance, []).append(item)
+
+        for instance_items in instances.values():
+            try:
+                bulk_delete(instance_items)
+                deleted.extend(instance_items)
+                continue
+            except Exception as e:
+                logging.warning('🚧 {} bulk delete failed, deleting items one by one: {}'.format(service, e))
+
+            with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as executor:
+                for candidate, success in zip(instance_items, executor.map(delete, instance_items)):
+                    if success:
+                        deleted.append(candidate)
+                    else:
+                        logging.error('❌ Failed to delete {} from {}'.format(candidate.title, service))
+
+    return deleted
+
+
+@instrumented
+def get_overseerr_requests():
+    logging.info('📦 Retrieving Overseerr requests')
+
+    headers = {
+        'X-Api-Key': OVERSEERR_APIKEY,
+    }
+
+    def fetch_page(skip):
+        payload = {
+            'take': OVERSEERR_PAGE_SIZE,
+            'skip': skip,
+            'sort': 'added'
+        }
+        r = get_session('overseerr').get(OVERSEERR_URL.rstrip('/') + '/api/v1/request', params=payload, headers=headers)
+        r.raise_for_status()
+        page = r.json()
+        # Only the fields the request index uses are kept from every page
+        page['results'] = [project_overseerr_request(result) for result in page['results']]
+        return page
+
+    try:
+        response = fetch_page(0)
+        pages = fetch_pages_concurrently(fetch_page, response, response['pageInfo']['results'], OVERSEERR_PAGE_SIZE)
+        response = [result for page in pages for result in page['results']]
+        logging.debug('get_overseerr_requests response: %s', response)
+
+        logging.info('✅ Retrieved {} Overseerr requests'.format(len(response)))
+        return response
+    except Exception as e:
+        logging.error('❌ Overseerr API \'request\' request failed: {0}'.format(e))
+
+
+def delete_overseerr_media(media_id):
+    headers = {
+        'X-Api-Key': OVERSEERR_APIKEY,
+    }
+
+    try:
+        r = get_session('overseerr').delete(OVERSEERR_URL.rstrip('/') + '/api/v1/media/{}'.format(media_id), headers=headers)
+        r.raise_for_status()
+        return True
+    except Exception as e:
+        logging.error('❌ Overseerr API \'media\' request for media {} failed: {}'.format(media_id, e))
+        return False
+
+
+@instrumented
+def clear_overseerr_media(deleted_candidates, remaining_candidates):
+    """Forget removed titles in Overseerr so they can be requested again
+
+    A title still in remaining_candidates, e.g. on another Radarr/Sonarr instance, stays available and isn't cleared.
+    """
+    # A removed season leaves the rest of its show available, so only whole movies and shows are cleared
+    available = {candidate.overseerr_media_id for candidate in remaining_candidates}
+    media_ids = sorted({candidate.overseerr_media_id for candidate in deleted_candidates
+                        if candidate.overseerr_media_id is not None and candidate.type != 'season'} - available)
+    if not media_ids:
+        return
+
+    logging.info('📦 Clearing {} removed titles from Overseerr'.format(len(media_ids)))
+    with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as executor:
+        cleared = sum(executor.map(delete_overseerr_media, media_ids))
+    logging.info('✅ Cleared {} of {} removed titles from Overseerr'.format(cleared, len(media_ids)))
+
+
+EXTERNAL_ID_TYPES = ('imdbId', 'tmdbId', 'tvdbId')
+
+
+@instrumented
+def build_external_id_index(library):
+    logging.info('📦 Indexing {} items by external id'.format(len(library)))
+    external_id_index = {}
 
     for item in library:
-        id_type = get_id_type(item)
-        if external_ids.get(id_type) == item.get(id_type):
-            return item, id_type
-
-    return None, id_type
-
-
-def start():
-    plex = setup_server(PLEX_URL, PLEX_TOKEN)
-    full_library_metadata: list[Any] = []
-    for library_name in PLEX_LIBRARY_NAMES:
-        full_library_metadata.extend(get_plex_libraries_metadata(plex, library_name))
-    for item in full_library_metadata:
-        history = get_full_plex_history(plex, item.ratingKey)
-        if len(history) > 0:
-            if item.addedAt > history[0].viewedAt:
-                item.lastViewedAt = item.addedAt
-            else:
-                item.lastViewedAt = history[0].viewedAt
+        for id_type in EXTERNAL_ID_TYPES:
+            # Radarr/Sonarr return tmdb/tvdb ids as integers, Plex guids are strings. The same title can be
+            # on several instances, e.g. a 1080p and a 4K Radarr, so every id maps to a list of items
+            if item.get(id_type):
+                external_id_index.setdefault((id_type, str(item[id_type])), []).append(item)
+
+    logging.info('✅ Indexed {} external ids'.format(len(external_id_index)))
+    return external_id_index
+
+
+def find_matching_items(candidate, external_id_index):
+    external_ids = candidate.external_ids()
+
+    for id_type in EXTERNAL_ID_TYPES:
+        if external_ids[id_type]:
+            items = external_id_index.get((id_type, external_ids[id_type]))
+            if items:
+                return items, id_type
+
+    return [], None
+
+
+def match_media_candidate(candidate, item):
+    candidate.title = item['title']
+    candidate.arr_id = item['id']
+    candidate.arr_instance = item['instance']
+    candidate.path = item.get('path')
+    if candidate.type == 'movie':
+        candidate.size = item['sizeOnDisk']
+    else:
+        candidate.size = item['statistics']['sizeOnDisk']
+
+
+@instrumented
+def build_candidates():
+    plex_connections = [setup_server(url, token) for url, token in PLEX_SERVERS]
+
+    # Every instance and server is fetched at once, they only meet in the external id join below
+    tasks = {}
+    for instance in range(len(RADARR_INSTANCES)):
+        tasks['radarr_movies_{}'.format(instance)] = ('radarr', get_radarr_movies, (instance,))
+    for instance in range(len(SONARR_INSTANCES)):
+        tasks['sonarr_shows_{}'.format(instance)] = ('sonarr', get_sonarr_shows, (instance,))
+    # While webhooks keep the last watched index current, history is only swept to reconcile missed events
+    history_args = ()
+    if webhook_server is not None:
+        reconcile_since = load_last_watched_index()['reconciled_at']
+        if time.time() - reconcile_since > LAST_WATCHED_RECONCILE_INTERVAL:
+            history_args = (datetime.datetime.fromtimestamp(reconcile_since),)
         else:
-            item.lastViewedAt = item.addedAt
-    sorted_full_library_metadata = sorted(full_library_metadata, key=sort_library_metadata, reverse=False)
+            history_args = None
+    for server, plex in enumerate(plex_connections):
+        if history_args is not None:
+            tasks['plex_history_{}'.format(server)] = ('plex', get_plex_history, (plex,) + history_args)
+        for library_name in PLEX_LIBRARY_NAMES:
+            tasks['plex_library_{}_{}'.format(server, library_name)] = ('plex', get_plex_libraries_metadata, (plex, library_name))
+    if OVERSEERR_URL:
+        tasks['overseerr_requests'] = ('overseerr', get_overseerr_requests, ())
+    upstream = fetch_concurrently(tasks, FETCH_TIMEOUTS)
+
+    radarr_index = build_external_id_index([movie for instance in range(len(RADARR_INSTANCES))
+                                            for movie in upstream['radarr_movies_{}'.format(instance)] or []])
+    sonarr_shows = [show for instance in range(len(SONARR_INSTANCES))
+                    for show in upstream['sonarr_shows_{}'.format(instance)] or []]
+    sonarr_index = build_external_id_index(sonarr_shows)
+    show_seasons = {(show['instance'], show['id']): show['seasons'] for show in sonarr_shows}
+
+    # One candidate per matched Radarr/Sonarr item, the Plex items of every server matching it are folded into it.
+    # Only the compact candidates are returned, the plexapi objects and Radarr/Sonarr dicts are released with this frame
+    matched_candidates = {}
+    for server in range(len(plex_connections)):
+        library_metadata: list[Any] = []
+        for library_name in PLEX_LIBRARY_NAMES:
+            library_metadata.extend(upstream['plex_library_{}_{}'.format(server, library_name)] or [])
+        history = upstream.get('plex_history_{}'.format(server))
+        last_viewed_index = get_plex_last_viewed_index(library_metadata, history or [])
+        # Webhook rating keys are only unique on one server, the persisted index belongs to the first one
+        if webhook_server is not None and server == 0:
+            last_viewed_index = merge_last_watched_index(last_viewed_index, reconciled=history is not None)
+        season_last_viewed_index = get_season_last_viewed_index(last_viewed_index)
+
+        for library_item in library_metadata:
+            candidate = build_media_candidate(library_item, last_viewed_index, season_last_viewed_index)
+            candidate.plex_server = server
+            matching_items, id_type = find_matching_items(candidate, radarr_index if candidate.type == 'movie' else sonarr_index)
+            for matching_item in matching_items:
+                key = (candidate.type, matching_item['instance'], matching_item['id'])
+                if key in matched_candidates:
+                    merge_media_candidates(matched_candidates[key], candidate)
+                    continue
+                matched_candidate = copy.copy(candidate)
+                match_media_candidate(matched_candidate, matching_item)
+                matched_candidates[key] = matched_candidate
+    candidates: list[MediaCandidate] = list(matched_candidates.values())
+
+    if SEASON_CLEANUP:
+        candidates = split_show_candidates(candidates, show_seasons)
+    if upstream.get('overseerr_requests'):
+        apply_overseerr_request_index(candidates, build_overseerr_request_index(upstream['overseerr_requests']))
+
+    return candidates
+
+
+def get_candidates(max_age=0):
+    """Return the candidates and their score columns, reusing the last build while it is younger than max_age seconds"""
+    global library_candidates, library_candidates_built_at, library_score_columns
+
+    if library_candidates is None or time.monotonic() - library_candidates_built_at > max_age:
+        library_candidates = build_candidates()
+        library_score_columns = build_score_columns(library_candidates)
+        library_candidates_built_at = time.monotonic()
+    else:
+        logging.info('♻️ Reusing the library indexed {} seconds ago'.format(int(time.monotonic() - library_candidates_built_at)))
+    return library_candidates, library_score_columns
 
-    radarr_library = get_radarr_movies()
-    sonarr_library = get_sonarr_shows()
 
-    deleted_bytes = 0
-    free_diskspace = 0
+def start(bytes_to_delete, max_library_age=0):
+    global library_candidates, library_score_columns
+    candidates, score_columns = get_candidates(max_library_age)
+    if webhook_server is not None:
+        apply_last_watched_index(candidates, score_columns)
 
-    if SERVICE_TO_CHECK_FREE_DISKSPACE == 'sonarr':
-        free_diskspace = check_sonarr_free_diskspace(PATH_TO_CHECK)
-    elif SERVICE_TO_CHECK_FREE_DISKSPACE == 'radarr':
-        free_diskspace = check_radarr_free_diskspace(PATH_TO_CHECK)
+    if DRY_RUN:
+        logging.info("The following items should be deleted to be back at the set diskspace thresholds:")
+    else:
+        logging.info("Deleting items from Radarr/Sonarr till free diskspace is back at the set thresholds")
 
-    bytes_to_delete = (FREE_SPACE_THRESHOLD * 1073741824) - free_diskspace
+    scores, protected = score_media_candidates(score_columns, current_time(), RETENTION_WEIGHTS, OVERSEERR_PROTECTION_DAYS,
+                                               RETENTION_REQUEST_DECAY_DAYS)
+    if protected.any():
+        logging.info('🛡️ Kept {} items requested in the last {} days'.format(int(protected.sum()), OVERSEERR_PROTECTION_DAYS))
+
+    selected_candidates = plan_cleanup(iter_ranked_candidates(candidates, scores, ~protected), bytes_to_delete)
+    selected_bytes = sum(candidate.size for candidate in selected_candidates)
 
     if DRY_RUN:
-        logging.info("The following items should be deleted to be back at the set {} GB diskspace:".format(FREE_SPACE_THRESHOLD))
+        deleted_bytes = selected_bytes
     else:
-        logging.info("Deleting items from Radarr/Sonarr till free diskspace is at least {} GB".format(FREE_SPACE_THRESHOLD))
-
-    for library_item in sorted_full_library_metadata:
-        if library_item.type == 'movie':
-            matching_movie, id_type = find_matching_item(library_item, 'movie', radarr_library)
-            if matching_movie:
-                if not DRY_RUN:
-                    delete_radarr_movie(matching_movie)
-                else:
-                    logging.info("Movie: {}".format(matching_movie['title']))
-                deleted_bytes += matching_movie['sizeOnDisk']
-        else:  # Assuming 'show' type
-            matching_show, id_type = find_matching_item(library_item, 'show', sonarr_library)
-            if matching_show:
-                if not DRY_RUN:
-                    delete_sonarr_show(matching_show)
-                else:
-                    logging.info("Show: {} ".format(matching_show['title']))
-                deleted_bytes += matching_show['statistics']['sizeOnDisk']
-        if deleted_bytes > bytes_to_delete:
-            break
+        deleted_candidates = delete_candidates(selected_candidates)
+        deleted_bytes = sum(candidate.size for candidate in deleted_candidates)
+        deleted_set = set(deleted_candidates)
+        kept_indexes = [index for index, candidate in enumerate(library_candidates) if candidate not in deleted_set]
+        library_candidates = [library_candidates[index] for index in kept_indexes]
+        library_score_columns = {name: column[kept_indexes] for name, column in library_score_columns.items()}
+        if OVERSEERR_URL:
+            clear_overseerr_media(deleted_candidates, library_candidates)
+        if len(deleted_set) < len(selected_candidates):
+            logging.warning('🚧 {} of {} selected items could not be deleted'
+                            .format(len(selected_candidates) - len(deleted_set), len(selected_candidates)))
+
+    run_metrics['bytes_freed'] = 0 if DRY_RUN else deleted_bytes
 
     if DRY_RUN:
         logging.info("Listted a total of {}".format(sizeof_fmt(deleted_bytes)))
@@ -314,7 +1193,278 @@ def start():
         logging.info("Deleted a total of {}".format(sizeof_fmt(deleted_bytes)))
 
 
-run_cleanup = check_diskspace(PATH_TO_CHECK, SERVICE_TO_CHECK_FREE_DISKSPACE, FREE_SPACE_THRESHOLD)
+def load_last_watched_index():
+    global last_watched_index
+
+    with last_watched_lock:
+        if last_watched_index is None:
+            try:
+                with open(LAST_WATCHED_INDEX_PATH) as f:
+                    data = json.load(f)
+                last_watched_index = {
+                    'reconciled_at': data['reconciled_at'],
+                    'items': {parse_index_key(key): viewed_at for key, viewed_at in data['items'].items()},
+                }
+            except FileNotFoundError:
+                last_watched_index = {'reconciled_at': 0, 'items': {}}
+        return last_watched_index
+
+
+def format_index_key(key):
+    # Season keys are (show rating key, season number) and are stored as 'show/season'
+    return '{}/{}'.format(*key) if isinstance(key, tuple) else str(key)
+
+
+def parse_index_key(key):
+    if '/' in key:
+        return get_season_key(*key.split('/'))
+    return int(key)
+
+
+def save_last_watched_index():
+    # One writer at a time, concurrent webhook handlers would otherwise replace each other's temporary file
+    with last_watched_save_lock:
+        with last_watched_lock:
+            data = json.dumps({
+                'reconciled_at': last_watched_index['reconciled_at'],
+                'items': {format_index_key(key): viewed_at for key, viewed_at in last_watched_index['items'].items()},
+            })
+        # Write to a temporary file first so a crash never leaves a truncated index behind
+        with open(LAST_WATCHED_INDEX_PATH + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(LAST_WATCHED_INDEX_PATH + '.tmp', LAST_WATCHED_INDEX_PATH)
+
+
+def flush_last_watched_index():
+    global last_watched_save_timer
+    with last_watched_lock:
+        last_watched_save_timer = None
+    save_last_watched_index()
+
+
+def schedule_last_watched_save():
+    """Write the index once LAST_WATCHED_SAVE_DELAY has passed, plays arriving meanwhile are written along with it
+
+    Plays lost to a crash before then are newer than reconciled_at and are picked up by the next history sweep.
+    """
+    global last_watched_save_timer
+    with last_watched_lock:
+        if last_watched_save_timer is not None:
+            return
+        last_watched_save_timer = threading.Timer(LAST_WATCHED_SAVE_DELAY, flush_last_watched_index)
+        last_watched_save_timer.daemon = True
+        last_watched_save_timer.start()
+
+
+def record_plays(plays, deferred=False):
+    """Store (rating key or season key, epoch seconds) plays in the persisted last watched index"""
+    index = load_last_watched_index()
+    with last_watched_lock:
+        for rating_key, viewed_at in plays:
+            update_last_viewed_index(index['items'], rating_key, viewed_at)
+    if deferred:
+        schedule_last_watched_save()
+    else:
+        save_last_watched_index()
+
+
+def merge_last_watched_index(last_viewed_index, reconciled):
+    record_plays(last_viewed_index.items())
+    index = load_last_watched_index()
+    if reconciled:
+        with last_watched_lock:
+            index['reconciled_at'] = int(time.time())
+        save_last_watched_index()
+    with last_watched_lock:
+        return dict(index['items'])
+
+
+@instrumented
+def apply_last_watched_index(candidates, score_columns):
+    """Bring plays recorded by webhooks since the candidates were built into them and their score columns"""
+    with last_watched_lock:
+        items = dict(last_watched_index['items'])
+    season_last_viewed_index = get_season_last_viewed_index(items)
+
+    for index, candidate in enumerate(candidates):
+        # Webhook rating keys are only unique on one server, the persisted index belongs to the first one
+        if candidate.plex_server != 0:
+            continue
+        if candidate.type == 'season':
+            viewed_at = items.get((candidate.rating_key, candidate.season))
+        else:
+            viewed_at = items.get(candidate.rating_key)
+            if candidate.type == 'show' and candidate.rating_key in season_last_viewed_index:
+                season_last_viewed = dict(candidate.season_last_viewed or {})
+                for season, season_viewed_at in season_last_viewed_index[candidate.rating_key].items():
+                    season_last_viewed[season] = max(season_last_viewed.get(season, 0), season_viewed_at)
+                candidate.season_last_viewed = season_last_viewed
+        if viewed_at and viewed_at > (candidate.last_viewed_at or 0):
+            candidate.last_viewed_at = viewed_at
+            score_columns['last_activity'][index] = candidate.last_activity_at()
+    return candidates
+
+
+def parse_webhook_plays(content_type, body):
+    """Return the rating keys and season keys played in a Plex (multipart) or Tautulli (JSON) webhook
+
+    Tautulli's webhook agent should send a JSON body with rating_key, grandparent_rating_key, parent_media_index
+    and optionally timestamp, e.g. {"rating_key": "{rating_key}", "grandparent_rating_key": "{grandparent_rating_key}",
+    "parent_media_index": "{season_num}"}.
+    """
+    if content_type.startswith('multipart/form-data'):
+        from email.parser import BytesParser
+        message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        payload = None
+        for part in message.walk():
+            if part.get_param('name', header='content-disposition') == 'payload':
+                payload = json.loads(part.get_payload(decode=True))
+        if payload is None or payload.get('event') not in PLEX_PLAYBACK_EVENTS:
+            return []
+        metadata = payload.get('Metadata', {})
+        # Plex sends the event as it happens, Metadata.lastViewedAt is still the view before this one
+        viewed_at = int(time.time())
+        rating_keys = [metadata.get('ratingKey'), metadata.get('grandparentRatingKey')]
+        season_key = get_season_key(metadata.get('grandparentRatingKey'), metadata.get('parentIndex'))
+    else:
+        payload = json.loads(body)
+        viewed_at = int(payload.get('timestamp') or time.time())
+        rating_keys = [payload.get('rating_key'), payload.get('grandparent_rating_key')]
+        season_key = get_season_key(payload.get('grandparent_rating_key'), payload.get('parent_media_index') or None)
+
+    plays = [(int(rating_key), viewed_at) for rating_key in rating_keys if rating_key]
+    if season_key:
+        plays.append((season_key, viewed_at))
+    return plays
+
+
+def make_webhook_handler():
+    # Imported here so runs without webhooks never load the HTTP server
+    from http.server import BaseHTTPRequestHandler
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def is_authorized(self):
+            # Plex webhooks can't set headers, so the token may also come as a query parameter of the webhook URL
+            token = self.headers.get('X-Webhook-Token') or parse_qs(urlsplit(self.path).query).get('token', [''])[0]
+            return hmac.compare_digest(token.encode(), WEBHOOK_TOKEN.encode())
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not self.is_authorized():
+                logging.warning('🚧 Rejected webhook from {} without a valid token'.format(self.client_address[0]))
+                self.send_response(403)
+                self.end_headers()
+                return
+
+            try:
+                plays = parse_webhook_plays(self.headers.get('Content-Type', ''), body)
+            except (ValueError, TypeError) as e:
+                logging.warning('🚧 Ignoring unreadable webhook: {0}'.format(e))
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            try:
+                if plays:
+                    record_plays(plays, deferred=True)
+                    logging.debug('Recorded plays from webhook: ' + str(plays))
+            except Exception as e:
+                logging.error('❌ Failed to record webhook plays: {0}'.format(e))
+                self.send_response(500)
+                self.end_headers()
+                return
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logging.debug('webhook: ' + format % args)
+
+    return WebhookHandler
+
+
+def start_webhook_listener(port, address=WEBHOOK_BIND_ADDRESS):
+    global webhook_server
+    from http.server import ThreadingHTTPServer
+
+    if not WEBHOOK_TOKEN:
+        raise ValueError('WEBHOOK_TOKEN must be set to receive webhooks')
+    load_last_watched_index()
+
+    class WebhookServer(ThreadingHTTPServer):
+        # The default backlog of 5 resets connections when Tautulli sends a burst of notifications
+        request_queue_size = WEBHOOK_BACKLOG
+
+    webhook_server = WebhookServer((address, port), make_webhook_handler())
+    threading.Thread(target=webhook_server.serve_forever, daemon=True).start()
+    logging.info('👂 Listening for Plex/Tautulli webhooks on {}:{}'.format(address, port))
+
+
+def get_poll_interval(diskspace, freespace_thresholds):
+    """Poll more often the closer any mount is to its threshold"""
+    if diskspace is None:
+        return DAEMON_POLL_INTERVAL_MIN
+
+    poll_interval = DAEMON_POLL_INTERVAL_MAX
+    for _, free_diskspace, freespace_threshold in get_mount_thresholds(diskspace, freespace_thresholds):
+        if freespace_threshold <= 0:
+            continue
+
+        headroom = (free_diskspace - freespace_threshold * 1073741824) / (freespace_threshold * 1073741824)
+        scale = min(max(headroom / DAEMON_FULL_HEADROOM, 0), 1)
+        poll_interval = min(poll_interval, DAEMON_POLL_INTERVAL_MIN + (DAEMON_POLL_INTERVAL_MAX - DAEMON_POLL_INTERVAL_MIN) * scale)
+
+    return int(poll_interval)
+
+
+def run_daemon():
+    logging.info('🔁 Running as a daemon, checking diskspace every {} to {} seconds'
+                 .format(DAEMON_POLL_INTERVAL_MIN, DAEMON_POLL_INTERVAL_MAX))
+
+    while True:
+        reset_metrics()
+        try:
+            diskspace = get_diskspace(SERVICE_TO_CHECK_FREE_DISKSPACE)
+            bytes_to_delete_per_mount = check_diskspace(diskspace, SERVICE_TO_CHECK_FREE_DISKSPACE, FREE_SPACE_THRESHOLDS)
+            if bytes_to_delete_per_mount:
+                start(bytes_to_delete_per_mount, max_library_age=DAEMON_LIBRARY_MAX_AGE)
+            poll_interval = get_poll_interval(diskspace, FREE_SPACE_THRESHOLDS)
+        except Exception as e:
+            logging.error('❌ Cleanup run failed: {0}'.format(e))
+            poll_interval = DAEMON_POLL_INTERVAL_MIN
+        write_metrics(METRICS_REVISION)
+        save_recording(METRICS_REVISION)
+
+        logging.info('💤 Next diskspace check in {} seconds'.format(poll_interval))
+        time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete the least recently watched media when diskspace runs low')
+    parser.add_argument('--daemon', action='store_true', help='keep running and poll diskspace with an adaptive interval')
+    parser.add_argument('--webhook-port', type=int, help='with --daemon, keep the last watched index current from '
+                                                         'Plex/Tautulli webhooks received on this port')
+    parser.add_argument('--webhook-address', default=WEBHOOK_BIND_ADDRESS,
+                        help='address the webhook listener binds to (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.webhook_port and not args.daemon:
+        parser.error('--webhook-port requires --daemon')
+    if args.webhook_port and not WEBHOOK_TOKEN:
+        parser.error('--webhook-port requires WEBHOOK_TOKEN to be set')
+
+    if REPLAY_PATH:
+        load_recording(REPLAY_PATH)
+        DRY_RUN = True  # A replayed run only plans, its deletes would never reach the servers
+
+    if args.daemon:
+        if args.webhook_port:
+            start_webhook_listener(args.webhook_port, args.webhook_address)
+        run_daemon()
+    else:
+        bytes_to_delete_per_mount = check_diskspace(get_diskspace(SERVICE_TO_CHECK_FREE_DISKSPACE),
+                                                    SERVICE_TO_CHECK_FREE_DISKSPACE, FREE_SPACE_THRESHOLDS)
 
-if run_cleanup:
-    start()
+        if bytes_to_delete_per_mount:
+            start(bytes_to_delete_per_mount)
+        write_metrics(METRICS_REVISION)
+        save_recording(METRICS_REVISION)
@@ -0,0 +1,532 @@
+"""Upstream client, record/replay, run metrics and candidate scoring shared by the media manager revisions
+
+Both revisions import this module from their own directory, so it has to sit next to them.
+"""
+
+import base64
+import datetime
+import functools
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# EDIT PARAMETERS IN .env FILE #
+METRICS_TEXTFILE_PATH = os.getenv('METRICS_TEXTFILE_PATH')  # e.g. /var/lib/node_exporter/textfile/media_manager.prom
+RUN_SUMMARY_PATH = os.getenv('RUN_SUMMARY_PATH')  # JSON summary of the last run
+RECORD_PATH = os.getenv('RECORD_PATH')  # Save every upstream response of the run to this gzipped archive
+REPLAY_PATH = os.getenv('REPLAY_PATH')  # Answer every upstream request from this archive instead of the network
+
+HTTP_TIMEOUT = (10, 120)  # Connect and read timeout in seconds
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.5  # Seconds, doubled on every retry
+HTTP_POOL_SIZE = 8  # Keep-alive connections per service
+PAGE_FETCH_CONCURRENCY = 4  # Maximum pages requested at once per paginated endpoint
+JSON_STREAM_CHUNK_SIZE = 64 * 1024  # Bytes read at a time from large Radarr/Sonarr responses
+RECORDING_SECRET_PARAMETERS = ('apikey', 'X-Plex-Token')  # Never written to the archive
+
+JSON_ARRAY_SEPARATOR = re.compile(r'[\s,]*')
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+recording = {}
+recording_lock = threading.Lock()
+reference_time = None  # Time of the recorded run while replaying
+
+stage_metrics = {}
+service_metrics = {}
+run_metrics = {}
+run_started_at = time.time()
+metrics_lock = threading.Lock()
+current_stage = threading.local()
+
+STAGE_METRIC_HELP = {
+    'calls': 'Calls of the stage during the last run',
+    'seconds': 'Seconds spent in the stage during the last run',
+    'http_requests': 'HTTP requests made by the stage during the last run',
+    'response_bytes': 'Response bytes received by the stage during the last run',
+    'items_in': 'Items passed into the stage during the last run',
+    'items_out': 'Items returned by the stage during the last run',
+}
+SERVICE_METRIC_HELP = {
+    'http_requests': 'HTTP requests made to the service during the last run',
+    'response_bytes': 'Response bytes received from the service during the last run',
+}
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = HTTP_TIMEOUT
+        return super().send(request, **kwargs)
+
+
+class RecordingHTTPAdapter(TimeoutHTTPAdapter):
+    """Forward requests upstream and keep a copy of every response for the recording archive"""
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        entry = {
+            'status': response.status_code,
+            'reason': response.reason,
+            'content_type': response.headers.get('Content-Type'),
+            'body': base64.b64encode(response.content).decode('ascii'),
+        }
+        with recording_lock:
+            recording.setdefault(get_recording_key(request), []).append(entry)
+        # Reading the content drained the connection, streaming readers such as the Plex XML loader read this copy
+        response.raw = io.BytesIO(response.content)
+        return response
+
+
+class ReplayHTTPAdapter(BaseAdapter):
+    """Answer requests from the recording archive without touching the network"""
+    def __init__(self):
+        super().__init__()
+        self.positions = {}
+
+    def send(self, request, **kwargs):
+        key = get_recording_key(request)
+        with recording_lock:
+            entries = recording.get(key)
+            if not entries:
+                raise requests.exceptions.ConnectionError('No recorded response for {} {}'.format(request.method, key))
+            # Repeated requests get their responses in recorded order, the last one is reused once they run out
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            entry = entries[min(position, len(entries) - 1)]
+
+        response = requests.models.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        if entry['content_type']:
+            response.headers['Content-Type'] = entry['content_type']
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(entry['body'])
+        response._content_consumed = True
+        response.raw = io.BytesIO(response._content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class MediaCandidate:
+    """Compact record of a library item that can be removed, shared by the matching and cleanup code"""
+    __slots__ = ('rating_key', 'type', 'title', 'imdb_id', 'tmdb_id', 'tvdb_id',
+                 'added_at', 'last_viewed_at', 'size', 'arr_id', 'path', 'season', 'episode_file_ids',
+                 'overseerr_media_id', 'requested_at', 'arr_instance', 'season_last_viewed', 'play_count', 'rating',
+                 'plex_server')
+
+    def __init__(self, rating_key, type, title, imdb_id=None, tmdb_id=None, tvdb_id=None,
+                 added_at=0, last_viewed_at=None, size=0, arr_id=None, path=None, season=None, episode_file_ids=None,
+                 overseerr_media_id=None, requested_at=None, arr_instance=None, season_last_viewed=None,
+                 play_count=0, rating=None, plex_server=None):
+        self.rating_key = rating_key
+        self.type = type
+        self.title = title
+        self.imdb_id = imdb_id
+        self.tmdb_id = tmdb_id
+        self.tvdb_id = tvdb_id
+        self.added_at = added_at  # Epoch seconds
+        self.last_viewed_at = last_viewed_at  # Epoch seconds, None when never played
+        self.size = size  # Bytes
+        self.arr_id = arr_id
+        self.path = path
+        self.season = season  # Season number when type is 'season'
+        self.episode_file_ids = episode_file_ids  # Sonarr episode files making up a season, looked up when it is deleted
+        self.overseerr_media_id = overseerr_media_id
+        self.requested_at = requested_at  # Epoch seconds of the latest Overseerr request, None when never requested
+        self.arr_instance = arr_instance  # Position of the Radarr/Sonarr instance in revision 3's instance lists
+        self.season_last_viewed = season_last_viewed  # Epoch seconds each season of a show was last played
+        self.play_count = play_count
+        self.rating = rating  # Out of 10, None when unrated
+        self.plex_server = plex_server  # Position of the Plex server of rating_key in revision 3's PLEX_SERVERS
+
+    def __repr__(self):
+        if self.type == 'season':
+            return 'MediaCandidate({!r}, {!r}, {!r}, season={!r})'.format(self.rating_key, self.type, self.title, self.season)
+        return 'MediaCandidate({!r}, {!r}, {!r})'.format(self.rating_key, self.type, self.title)
+
+    def last_activity_at(self):
+        return max(self.added_at, self.last_viewed_at or 0)
+
+    def external_ids(self):
+        return {'imdbId': self.imdb_id, 'tmdbId': self.tmdb_id, 'tvdbId': self.tvdb_id}
+
+
+def reset_metrics():
+    global run_started_at
+    with metrics_lock:
+        stage_metrics.clear()
+        service_metrics.clear()
+        run_metrics.clear()
+    run_started_at = time.time()
+
+
+def record_http_response(service, response, *args, **kwargs):
+    # Streamed bodies haven't been read yet, they are counted when the stage that reads them ends
+    if kwargs.get('stream'):
+        response_size = 0
+        if getattr(current_stage, 'streams', None):
+            current_stage.streams[-1].append(response)
+    else:
+        response_size = len(response.content)
+
+    stage = current_stage.names[-1] if getattr(current_stage, 'names', None) else None
+    with metrics_lock:
+        metrics = service_metrics.setdefault(service, {'http_requests': 0, 'response_bytes': 0})
+        metrics['http_requests'] += 1
+        metrics['response_bytes'] += response_size
+        if stage is not None:
+            stage_metrics[stage]['http_requests'] += 1
+            stage_metrics[stage]['response_bytes'] += response_size
+
+
+def instrumented(function):
+    """Record duration, HTTP calls, response bytes and items in/out of every call to function"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stage = function.__name__
+        with metrics_lock:
+            metrics = stage_metrics.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'http_requests': 0,
+                                                       'response_bytes': 0, 'items_in': 0, 'items_out': 0})
+            metrics['calls'] += 1
+            metrics['items_in'] += sum(len(arg) for arg in args if isinstance(arg, (list, tuple, set)))
+
+        if getattr(current_stage, 'names', None) is None:
+            current_stage.names = []
+            current_stage.streams = []
+        current_stage.names.append(stage)
+        current_stage.streams.append([])
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            current_stage.names.pop()
+            streamed_bytes = sum(response.raw.tell() for response in current_stage.streams.pop())
+            with metrics_lock:
+                metrics['seconds'] += time.perf_counter() - started
+                metrics['response_bytes'] += streamed_bytes
+
+        if isinstance(result, (list, tuple, set, dict)):
+            with metrics_lock:
+                metrics['items_out'] += len(result)
+        return result
+    return wrapper
+
+
+def write_metrics(revision):
+    if not METRICS_TEXTFILE_PATH and not RUN_SUMMARY_PATH:
+        return
+
+    with metrics_lock:
+        summary = {
+            'revision': revision,
+            'started_at': run_started_at,
+            'duration_seconds': time.time() - run_started_at,
+            'bytes_freed': run_metrics.get('bytes_freed', 0),
+            'stages': {stage: dict(metrics) for stage, metrics in stage_metrics.items()},
+            'services': {service: dict(metrics) for service, metrics in service_metrics.items()},
+        }
+
+    if RUN_SUMMARY_PATH:
+        write_file_atomically(RUN_SUMMARY_PATH, json.dumps(summary, indent=2))
+
+    if METRICS_TEXTFILE_PATH:
+        lines = []
+        for name, help_text, value in (
+                ('last_run_timestamp_seconds', 'Start of the last run', summary['started_at']),
+                ('last_run_duration_seconds', 'Duration of the last run', summary['duration_seconds']),
+                ('last_run_bytes_freed', 'Bytes freed by the last run', summary['bytes_freed'])):
+            lines.append('# HELP media_manager_{} {}'.format(name, help_text))
+            lines.append('# TYPE media_manager_{} gauge'.format(name))
+            lines.append('media_manager_{}{{revision="{}"}} {}'.format(name, revision, value))
+
+        for label, series, help_texts in (('stage', summary['stages'], STAGE_METRIC_HELP),
+                                          ('service', summary['services'], SERVICE_METRIC_HELP)):
+            for metric, help_text in help_texts.items():
+                name = 'media_manager_{}_{}'.format(label, metric)
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} gauge'.format(name))
+                for key, metrics in series.items():
+                    lines.append('{}{{revision="{}",{}="{}"}} {}'.format(name, revision, label, key, metrics[metric]))
+
+        write_file_atomically(METRICS_TEXTFILE_PATH, '\n'.join(lines) + '\n')
+
+    logging.info('📈 Wrote run metrics for {} stages'.format(len(summary['stages'])))
+
+
+def write_file_atomically(path, content):
+    # The textfile collector may read at any moment, it must never see a half written file
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def get_session(service):
+    """Return the pooled keep-alive session shared by every request to service"""
+    with sessions_lock:
+        if service not in sessions:
+            retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset({'GET', 'DELETE'}))
+            if REPLAY_PATH:
+                adapter = ReplayHTTPAdapter()
+            elif RECORD_PATH:
+                adapter = RecordingHTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            else:
+                adapter = TimeoutHTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+            session.hooks['response'].append(functools.partial(record_http_response, service))
+            sessions[service] = session
+        return sessions[service]
+
+
+def get_recording_key(request):
+    """Identify a request in the recording archive, leaving out credentials"""
+    url = urlsplit(request.url)
+    query = sorted((k, v) for k, v in parse_qsl(url.query, keep_blank_values=True)
+                   if k not in RECORDING_SECRET_PARAMETERS)
+    paging = [request.headers.get(header) for header in ('X-Plex-Container-Start', 'X-Plex-Container-Size')]
+    return json.dumps([request.method, url.netloc + url.path, query, paging])
+
+
+def load_recording(path):
+    global reference_time
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        archive = json.load(f)
+    recording.update(archive['responses'])
+    reference_time = archive['recorded_at']
+    logging.info('📼 Replaying {} recorded requests from {}, recorded at {}'.format(
+        len(recording), path, datetime.datetime.fromtimestamp(reference_time)))
+
+
+def save_recording(revision):
+    if not RECORD_PATH:
+        return
+    with recording_lock:
+        archive = {'recorded_at': run_started_at, 'revision': revision, 'responses': recording}
+        with gzip.open(RECORD_PATH + '.tmp', 'wt', encoding='utf-8') as f:
+            json.dump(archive, f)
+    os.replace(RECORD_PATH + '.tmp', RECORD_PATH)
+    logging.info('📼 Recorded {} upstream requests to {}'.format(len(recording), RECORD_PATH))
+
+
+def current_time():
+    """Time the run is planned at, the time of the recorded run while replaying"""
+    return reference_time or time.time()
+
+
+def submit_daemon(function, *args):
+    """Run function on a daemon thread, unlike executor workers it never holds up the exit of the process"""
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def fetch_concurrently(tasks, timeouts):
+    """Run independent upstream fetches at once, tasks maps a name to (service, function, args)
+
+    timeouts maps every service to the seconds its fetches are waited for. A fetch that runs longer is
+    abandoned: its result is None and its thread keeps going until its requests end or hit HTTP_TIMEOUT,
+    without delaying the exit of the process.
+    """
+    logging.info('📦 Fetching {} upstream resources concurrently'.format(len(tasks)))
+
+    results = {}
+    started = time.monotonic()
+    futures = {name: (service, submit_daemon(function, *args)) for name, (service, function, args) in tasks.items()}
+
+    for name, (service, future) in futures.items():
+        remaining = max(0, started + timeouts[service] - time.monotonic())
+        try:
+            results[name] = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            logging.error('❌ {} fetch \'{}\' timed out after {} seconds'.format(service, name, timeouts[service]))
+            results[name] = None
+        except Exception as e:
+            logging.error('❌ {} fetch \'{}\' failed: {}'.format(service, name, e))
+            results[name] = None
+
+    logging.info('✅ Fetched {} upstream resources in {:.1f} seconds'.format(len(tasks), time.monotonic() - started))
+    return results
+
+
+def fetch_pages_concurrently(fetch_page, first_page, total, page_size):
+    """Fetch the pages following first_page concurrently, fetch_page takes the offset of a page"""
+    offsets = range(page_size, total, page_size)
+    stages = list(getattr(current_stage, 'names', None) or [])
+
+    def fetch_page_in_stage(offset):
+        # Pages are requests of the calling stage, not of the worker thread
+        current_stage.names = stages
+        current_stage.streams = [[]]
+        try:
+            return fetch_page(offset)
+        finally:
+            # Streamed pages are read by now, their bytes count towards the calling stage like its own streams
+            streamed_bytes = sum(response.raw.tell() for response in current_stage.streams.pop())
+            if stages:
+                with metrics_lock:
+                    stage_metrics[stages[-1]]['response_bytes'] += streamed_bytes
+
+    with ThreadPoolExecutor(max_workers=PAGE_FETCH_CONCURRENCY) as executor:
+        # map keeps the pages in offset order regardless of which request finishes first
+        return [first_page] + list(executor.map(fetch_page_in_stage, offsets))
+
+
+def iter_json_array(response):
+    """Decode a top-level JSON array from a streamed response one element at a time
+
+    Raises ValueError when the body is not a JSON array or ends before the array is closed.
+    """
+    decoder = json.JSONDecoder()
+    response.encoding = response.encoding or 'utf-8'
+    buffer = ''
+    position = 0
+    started = False
+
+    for chunk in response.iter_content(chunk_size=JSON_STREAM_CHUNK_SIZE, decode_unicode=True):
+        buffer = buffer[position:] + chunk
+        position = JSON_ARRAY_SEPARATOR.match(buffer).end()
+
+        if not started and position < len(buffer):
+            if buffer[position] != '[':
+                raise ValueError('Expected a JSON array, got {!r}'.format(buffer[position:position + 80]))
+            started = True
+            position = JSON_ARRAY_SEPARATOR.match(buffer, position + 1).end()
+
+        while position < len(buffer) and buffer[position] != ']':
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # The element continues in the next chunk
+            yield item
+            position = JSON_ARRAY_SEPARATOR.match(buffer, position).end()
+
+    # A dropped connection ends the body early, the items decoded so far must not pass for the whole array
+    if not started or buffer[position:position + 1] != ']':
+        raise ValueError('Truncated JSON array, the response ended before its closing bracket')
+
+
+def project_overseerr_request(request):
+    media = request.get('media') or {}
+    return {
+        'id': request['id'],
+        'createdAt': request.get('createdAt'),
+        'media': {
+            'id': media.get('id'),
+            'mediaType': media.get('mediaType'),
+            'tmdbId': media.get('tmdbId'),
+            'tvdbId': media.get('tvdbId'),
+        },
+    }
+
+
+def parse_iso_date(value):
+    # Sonarr and Overseerr write UTC timestamps with a varying number of fractional digits, whole seconds are enough here
+    return int(datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+               .replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+@instrumented
+def build_overseerr_request_index(overseerr_requests):
+    """Index the latest request of every Overseerr media by (media type, external id type, external id)"""
+    logging.info('📦 Indexing {} Overseerr requests'.format(len(overseerr_requests)))
+    overseerr_request_index = {}
+
+    for request in overseerr_requests:
+        media = request['media']
+        if media['id'] is None:
+            continue
+        # TMDB numbers movies and shows separately, so the media type is part of the key
+        media_type = 'movie' if media['mediaType'] == 'movie' else 'show'
+        entry = (media['id'], parse_iso_date(request['createdAt']) if request['createdAt'] else 0)
+        for id_type in ('tmdbId', 'tvdbId'):
+            if media[id_type]:
+                key = (media_type, id_type, str(media[id_type]))
+                if key not in overseerr_request_index or overseerr_request_index[key][1] < entry[1]:
+                    overseerr_request_index[key] = entry
+
+    logging.info('✅ Indexed {} Overseerr media ids'.format(len(overseerr_request_index)))
+    return overseerr_request_index
+
+
+def apply_overseerr_request_index(candidates, overseerr_request_index):
+    for candidate in candidates:
+        media_type = 'movie' if candidate.type == 'movie' else 'show'
+        for id_type, external_id in (('tmdbId', candidate.tmdb_id), ('tvdbId', candidate.tvdb_id)):
+            entry = overseerr_request_index.get((media_type, id_type, str(external_id))) if external_id else None
+            if entry:
+                candidate.overseerr_media_id, candidate.requested_at = entry
+                break
+    return candidates
+
+
+def build_score_columns(candidates):
+    """Return the factors score_media_candidates reads as one array per factor, in candidate order
+
+    Reading the attributes of every candidate is the slow part of scoring, a library that is scored
+    more than once keeps these next to its candidates and updates them in place.
+    """
+    import numpy as np
+
+    count = len(candidates)
+    return {
+        'last_activity': np.fromiter((candidate.last_activity_at() for candidate in candidates), dtype=np.float64, count=count),
+        'size': np.fromiter((candidate.size or 0 for candidate in candidates), dtype=np.float64, count=count),
+        'play_count': np.fromiter((candidate.play_count or 0 for candidate in candidates), dtype=np.float64, count=count),
+        'rating': np.fromiter((np.nan if candidate.rating is None else candidate.rating for candidate in candidates),
+                              dtype=np.float64, count=count),
+        'requested_at': np.fromiter((np.nan if candidate.requested_at is None else candidate.requested_at
+                                     for candidate in candidates), dtype=np.float64, count=count),
+    }
+
+
+def score_media_candidates(columns, now, weights, protection_days, request_decay_days):
+    """Score every candidate in one pass over the columns of its factors, higher scores are removed first
+
+    columns come from build_score_columns. weights maps every factor (age, size, play_count, rating, requested)
+    to its score per unit. Returns the scores and a mask of the candidates protected by an Overseerr request
+    in the last protection_days.
+    """
+    import numpy as np
+
+    request_age = now - columns['requested_at']
+    scores = np.floor((now - columns['last_activity']) / 86400) * weights.get('age', 0)  # Whole days
+    scores += columns['size'] / 1024 ** 3 * weights.get('size', 0)
+    scores += columns['play_count'] * weights.get('play_count', 0)
+    scores += np.nan_to_num(columns['rating'] - 5) * weights.get('rating', 0)
+    scores += np.nan_to_num(np.exp(-request_age / (request_decay_days * 86400))) * weights.get('requested', 0)
+    with np.errstate(invalid='ignore'):
+        protected = request_age < protection_days * 86400
+    return scores, protected